@@ -0,0 +1,126 @@
+import math
+from array import array
+from mathutil import *
+from fov_plan import get_plan
+import fov_rho
+import fov_spiral_buggy
+import fov_permissive
+import fov_numpy
+
+"""
+    Batched FoV: compute the field of vision of many viewers against the same visibility map.
+
+    All viewer-independent precomputation (spiral plans, rhombus tables) is shared by the whole batch, and the results
+    are written into one preallocated stacked buffer (FovStack). With NumPy, the spiral and rhombus engines also
+    compute whole chunks of viewers together, so throughput scales with batch size rather than call count.
+"""
+
+# The algorithms fov_many can run, by module name
+ALGORITHMS = ('fov_rho', 'fov_spiral_buggy', 'fov_permissive')
+
+# Max number of floats of per-chunk working memory for the vectorized engines
+MAX_CHUNK_FLOATS = 1 << 22
+
+class FovStack(object):
+    """
+        The FoV results of a batch of viewers, stacked in one flat buffer (count x height x width, 0-initialised)
+        Each slice i has an origin (the absolute position of its (0,0) cell):
+            window slices: the (2r+1)^2 square around the viewer, r = ceil(losRadius). Cells off the map stay 0
+            full-map slices: the whole visibility map, origin (0,0)
+        data can be any writable buffer of doubles of the right size (e.g. shared memory); default is a new array
+    """
+    def __init__(self, count, width, height, data = None):
+        self.count = count
+        self.width = width
+        self.height = height
+        self.origins = [(0,0)] * count
+        self.data = array('d', [0.0]) * (count*width*height) if data is None else data
+
+    def clear(self):
+        # reset all values to 0
+        n = self.count*self.width*self.height
+        self.data[0:n] = array('d', [0.0]) * n
+
+    def offset(self, i):
+        # linear index of the first cell of slice i
+        return i*self.width*self.height
+
+    def get(self, i, point):
+        # value of slice i at an absolute position. 0 outside the slice
+        x = point.x - self.origins[i][0]
+        y = point.y - self.origins[i][1]
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return 0
+        return self.data[self.offset(i) + x + y*self.width]
+
+    def window(self, i):
+        # Zero-copy FovWindow over slice i of a window stack
+        n = self.width*self.height
+        return FovWindow.wrap(self.origins[i], (self.width-1)//2, memoryview(self.data)[self.offset(i):self.offset(i)+n])
+
+    def as_numpy(self):
+        # Zero-copy numpy view (count x height x width). Requires numpy
+        import numpy
+        return numpy.frombuffer(self.data, dtype=numpy.float64).reshape(self.count, self.height, self.width)
+
+def fov_many( viewers, losRadius, visibilityMap, algorithm = 'fov_rho', window = True, out = None):
+    """
+    Calculate the field-of-vision of each viewer in the list, with the given algorithm (see ALGORITHMS)
+    window: if True, each result is the (2r+1)^2 window around its viewer, otherwise a full map
+    out: optional FovStack to reuse, if it has the right shape (it gets cleared)
+    Returns a FovStack, slice i being the result of viewers[i]
+    """
+    assert algorithm in ALGORITHMS
+    count = len(viewers)
+    half = int(math.ceil(losRadius))
+    if window:
+        width = height = 2*half+1
+    else:
+        width = visibilityMap.width
+        height = visibilityMap.height
+    if out is not None and out.count == count and out.width == width and out.height == height:
+        out.clear()
+    else:
+        out = FovStack(count, width, height)
+    out.origins = [ (p.x-half, p.y-half) if window else (0,0) for p in viewers]
+
+    if fov_numpy.np is not None and algorithm != 'fov_permissive':
+        __fov_many_numpy(viewers, losRadius, visibilityMap, algorithm, out)
+        return out
+
+    # one viewer at a time, writing directly into the stack
+    if algorithm == 'fov_spiral_buggy':
+        plan = get_plan(losRadius, fov_spiral_buggy.DECAY_PER_TILE_PERCENT, fov_spiral_buggy.DECAY_FALLOFF)
+    for i,p in enumerate(viewers):
+        fbase = out.offset(i) + (p.x - out.origins[i][0]) + (p.y - out.origins[i][1])*width
+        if algorithm == 'fov_rho':
+            fov_rho.fov_into(p, losRadius, visibilityMap, out.data, fbase, width)
+        elif algorithm == 'fov_spiral_buggy':
+            plan.run_into(p, visibilityMap, out.data, fbase, width)
+        else:
+            fov_permissive.fov_into(p, losRadius, visibilityMap, out.data, fbase, width)
+    return out
+
+def __fov_many_numpy( viewers, losRadius, visibilityMap, algorithm, out):
+    # Vectorized engines: process chunks of viewers together, then scatter each chunk into the stack
+    np = fov_numpy.np
+    stack = out.as_numpy().reshape(out.count, out.width*out.height)
+    half = int(math.ceil(losRadius))
+    if algorithm == 'fov_spiral_buggy':
+        plan = get_plan(losRadius, fov_spiral_buggy.DECAY_PER_TILE_PERCENT, fov_spiral_buggy.DECAY_FALLOFF)
+        cellsPerViewer = plan.size
+    else:
+        cellsPerViewer = 8*(half+1)*(half+1)
+    chunk = max(1, MAX_CHUNK_FLOATS // (8*cellsPerViewer))
+    for start in range(0, len(viewers), chunk):
+        batch = viewers[start:start+chunk]
+        if algorithm == 'fov_spiral_buggy':
+            vals, px, py, inb = fov_numpy.spiral_values(plan, batch, visibilityMap)
+        else:
+            vals, px, py, inb = fov_numpy.rho_values(batch, losRadius, visibilityMap)
+        # local coordinates in each slice
+        ox = np.array([out.origins[start+i][0] for i in range(len(batch))]).reshape((-1,) + (1,)*(px.ndim-1))
+        oy = np.array([out.origins[start+i][1] for i in range(len(batch))]).reshape((-1,) + (1,)*(px.ndim-1))
+        local = (px - ox) + (py - oy)*out.width
+        rows = np.broadcast_to(np.arange(len(batch)).reshape((-1,) + (1,)*(px.ndim-1)), px.shape)
+        stack[start + rows[inb], local[inb]] = vals[inb]
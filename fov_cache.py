@@ -0,0 +1,71 @@
+import copy
+import importlib
+from collections import OrderedDict
+
+"""
+    LRU memoization of FoV results
+
+    Stationary viewers, or viewers that come back to the same positions, keep asking for the same FoV. The cache keys
+    each result by (viewer, radius, decay, algorithm, map, map version), so it only works with maps that have a
+    version counter (VersionedMap2D): any edit bumps the version, and results computed before the edit can never be
+    returned again (they just age out of the LRU). Maps without a version are not cached at all.
+
+    Results are shared between callers, so they are read-only: their data is a read-only memoryview, and set() raises.
+"""
+
+class FovCache(object):
+    """
+        LRU cache of FoV results, bounded by a number of entries and (optionally) by the total bytes of the results
+        Counters: hits, misses, evictions, bypasses (calls with an unversioned map)
+    """
+    def __init__(self, maxEntries = 256, maxBytes = None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict() # key -> (visibilityMap, result, nbytes), least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+        
+    def __len__(self):
+        return len(self.entries)
+        
+    def fov(self, viewerPos, losRadius, visibilityMap, algorithm = 'fov_rho'):
+        """
+        The FoV of algorithm (an engine module name, e.g. 'fov_rho'), computed with the module's fov() on a miss
+        The decay is the module's current DECAY_PER_TILE_PERCENT and DECAY_FALLOFF (if it has them)
+        """
+        module = importlib.import_module(algorithm)
+        version = getattr(visibilityMap, 'version', None)
+        if version is None:
+            self.bypasses += 1
+            return module.fov(viewerPos, losRadius, visibilityMap)
+        key = (viewerPos.x, viewerPos.y, losRadius, getattr(module, 'DECAY_PER_TILE_PERCENT', None),
+               getattr(module, 'DECAY_FALLOFF', None), algorithm, id(visibilityMap), version)
+        entry = self.entries.get(key)
+        # the map is kept in the entry, so the id in the key can't be reused by another map while the entry is alive
+        if entry is not None and entry[0] is visibilityMap:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        result = copy.copy(module.fov(viewerPos, losRadius, visibilityMap))
+        view = memoryview(result.data)
+        result.data = view.toreadonly()
+        self.entries[key] = (visibilityMap, result, view.nbytes)
+        self.entries.move_to_end(key)
+        self.nbytes += view.nbytes
+        self.__evict()
+        return result
+        
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        
+    def __evict(self):
+        # drop the least recently used entries until we're within bounds (the newest entry is always kept)
+        while len(self.entries) > 1 and (len(self.entries) > self.maxEntries or (self.maxBytes is not None and self.nbytes > self.maxBytes)):
+            (key, entry) = self.entries.popitem(last=False)
+            self.nbytes -= entry[2]
+            self.evictions += 1
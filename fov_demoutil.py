@@ -1,29 +1,124 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
 from mathutil import *
 
+"""
+    Map loading for the demos and tools
+
+    Text maps: one character per tile, w/ legend: '#' wall, '.' floor, '@' viewer path (floor). Any other character is
+    a wall. The loader never looks at single characters in python: the whole map is translated at once, straight into
+    the bytes of the visibility values (see load_from_file)
+
+    Binary maps (BINARY_EXTENSION): a small header, then the visibility values as they are stored in a Map2D, so that
+    the file can be memory-mapped and used directly as the storage of the visibility map. Layout (little-endian):
+        header: magic (8 bytes), width, height (uint32), typecode (1 byte, array typecode), 3 bytes padding,
+                path length (uint32)
+        data:   width*height values of the typecode, row by row
+        path:   path length (x,y) pairs (uint32)
+"""
+
+BINARY_EXTENSION = '.fovmap'
+BINARY_MAGIC = b'FOVMAP1\0'
+__HEADER = struct.Struct('<8sIIc3xI')
+
 def load_from_file( filename ):
-    # Expect a text file containing a map, w/ legend: '#' wall, '.' floor, 'X' viewer path (optional)
-    lines = open(filename, 'rt').read().split('\n')
+    # Expect a text file containing a map, w/ legend: '#' wall, '.' floor, '@' viewer path (optional)
+    # Returns (visibilityMap, path)
+    text = open(filename, 'rb').read()
+    # same line endings as reading in text mode
+    lines = text.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
     path = []
     visibilityMap = None
     if lines:
         w = len(lines[0])
         h = len(lines)
-        visibilityMap = Map2D(w,h)
-        for y in range(h):
-            for x in range(w):
-                char = lines[y][x]
-                p = ivec2(x,y)
-                if char == '#':
-                    visibilityMap.set(p,0)
-                elif char == '.':
-                    visibilityMap.set(p,1)
-                elif char == '@':
-                    visibilityMap.set(p,1)
-                    path.append(p)
-                    
+        # the characters of the map, row by row (missing characters, in short rows, are walls)
+        chars = bytearray(w*h)
+        for y,line in enumerate(lines):
+            chars[y*w : y*w + min(w, len(line))] = line[:w]
+        # The values are 0 or 1, and a double 0.0 is all zero bytes, so translate the characters to each of the
+        # non-zero bytes of a 1.0 (for floors), and interleave them into the values' bytes
+        one = array('d', [1.0]).tobytes()
+        values = bytearray(len(one)*w*h)
+        for k,byte in enumerate(one):
+            if byte:
+                table = bytearray(256)
+                table[ord('.')] = table[ord('@')] = byte
+                values[k::len(one)] = chars.translate(table)
+        visibilityMap = Map2D.from_buffer(w, h, array('d', values))
+        # the path, in row order
+        i = chars.find(b'@')
+        while i >= 0:
+            path.append(ivec2(i % w, i // w))
+            i = chars.find(b'@', i+1)
+
     return (visibilityMap, path)
-                
-if __name__ == '__main__':    
+
+def save_binary( filename, visibilityMap, path = () ):
+    # Save a visibility map (and an optional viewer path) in the binary format
+    data = array(memoryview(visibilityMap.data).format, visibilityMap.data)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    with open(filename, 'wb') as f:
+        f.write(__HEADER.pack(BINARY_MAGIC, visibilityMap.width, visibilityMap.height, data.typecode.encode('ascii'), len(path)))
+        f.write(data.tobytes())
+        f.write(struct.pack('<%dI' % (2*len(path)), *[c for p in path for c in (p.x, p.y)]))
+
+def load_binary( filename, use_mmap = True ):
+    """
+    Load a binary map. Returns (visibilityMap, path)
+    use_mmap: if True, the map's storage is the memory-mapped file itself (copy-on-write: edits stay in memory, the
+              file is never modified), so loading is instant and only the pages that are read get loaded.
+              Otherwise, (or on big-endian machines) the values are copied into an array
+    """
+    with open(filename, 'rb') as f:
+        (magic, w, h, typecode, pathLength) = __HEADER.unpack(f.read(__HEADER.size))
+        assert magic == BINARY_MAGIC, "not a binary map: " + filename
+        typecode = typecode.decode('ascii')
+        nbytes = w*h*array(typecode).itemsize
+        if use_mmap and sys.byteorder == 'little' and nbytes > 0:
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+            data = memoryview(buf)[__HEADER.size : __HEADER.size + nbytes].cast(typecode)
+            pathBytes = buf[__HEADER.size + nbytes : __HEADER.size + nbytes + 8*pathLength]
+        else:
+            data = array(typecode)
+            data.frombytes(f.read(nbytes))
+            if sys.byteorder == 'big':
+                data.byteswap()
+            pathBytes = f.read(8*pathLength)
+    coords = struct.unpack('<%dI' % (2*pathLength), pathBytes)
+    path = [ ivec2(coords[2*i], coords[2*i+1]) for i in range(pathLength)]
+    return (Map2D.from_buffer(w, h, data), path)
+
+def load( filename ):
+    # Load a text or a binary map, by extension. Returns (visibilityMap, path)
+    if filename.endswith(BINARY_EXTENSION):
+        return load_binary(filename)
+    return load_from_file(filename)
+
+class MapList(object):
+    """
+        The maps of a directory, loaded lazily (on first access) and kept
+        names: the file names, sorted. maps[i] is (visibilityMap, path), like load()
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = sorted(os.listdir(directory))
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        result = self.loaded.get(i)
+        if result is None:
+            result = self.loaded[i] = load(os.path.join(self.directory, self.names[i]))
+        return result
+
+if __name__ == '__main__':
     vmap, path = load_from_file("fov_demomap_1.txt")
     print(vmap)
-    print(path)
\ No newline at end of file
+    print(path)
@@ -0,0 +1,207 @@
+import math
+from array import array
+from mathutil import *
+from fov_plan import get_plan
+import fov_spiral_buggy
+
+"""
+    Incremental spiral FoV for a moving viewer
+
+    The spiral engine is translation invariant: the value at an offset o from the viewer only depends on the
+    visibility at the offsets o depends on (its ancestors in the FovPlan). So when the viewer moves, the previous
+    value at offset o is still exact if the visibility at o's ancestors is the same in the new frame as it was in
+    the old frame. The values are kept frame-relative, in a (2r+1)^2 window around the viewer, so moving the viewer
+    moves the window origin, and only the offsets downstream of a visibility difference get recomputed.
+    In open areas that is almost nothing.
+"""
+
+class IncrementalFov(object):
+    """
+        The spiral FoV of a single moving viewer, updated incrementally
+
+        Contract:
+            - update(viewerPos) always gives exactly the result of a full fov_spiral_buggy.fov (with the same decay and falloff)
+            - the previous result is reused when the move is at most maxStep tiles (Chebyshev distance), and both the
+              old and new (2r+1)^2 windows are fully inside the map, and the move dirties at most maxDirtyRatio of the
+              points. Otherwise update() does a full recompute
+            - map edits between updates are fine: reuse compares against a snapshot of the visibility of the previous
+              window, not against the live map
+            - the result is the FovWindow self.window (also readable with get(point), with absolute positions), and
+              it's overwritten by the next update
+        Counters: fullUpdates, incrementalUpdates, recomputedPoints (points recomputed by incremental updates)
+    """
+    def __init__(self, losRadius, visibilityMap, decayPercent = None, maxStep = 1, maxDirtyRatio = 0.25, falloff = None):
+        self.losRadius = losRadius
+        self.visibilityMap = visibilityMap
+        self.decayPercent = decayPercent
+        self.falloff = falloff
+        self.maxStep = maxStep
+        self.maxDirtyRatio = maxDirtyRatio # max fraction of the points to recompute incrementally, before falling back to a full update
+        self.half = int(math.ceil(losRadius))
+        self.side = 2*self.half+1
+        self.center = self.half + self.half*self.side
+        self.plan = None
+
+        self.viewerPos = None
+        self.window = FovWindow(ivec2(0,0), losRadius) # frame-relative values (the window around the viewer)
+        self.values = self.window.data
+        self.snapshot = array(memoryview(visibilityMap.data).format, [0]) * (self.side*self.side) # visibility of the window, when it was last updated
+        self.end = 0 # number of plan points before the early exit
+        self.bandMax = [] # farthest visible point of each plan band
+        self.reusable = False # if the current window is fully in the map, so it can be reused
+
+        self.fullUpdates = 0
+        self.incrementalUpdates = 0
+        self.recomputedPoints = 0
+
+    def get(self, point):
+        return self.window.get(point)
+
+    def update(self, viewerPos):
+        # Move the viewer and update its FoV. Returns self
+        decayPercent = fov_spiral_buggy.DECAY_PER_TILE_PERCENT if self.decayPercent is None else self.decayPercent
+        falloff = fov_spiral_buggy.DECAY_FALLOFF if self.falloff is None else self.falloff
+        m = self.visibilityMap
+        r = self.half
+        inside = viewerPos.x >= r and viewerPos.y >= r and viewerPos.x + r < m.width and viewerPos.y + r < m.height
+        if self.plan is None or self.plan.decayPercent != decayPercent or self.plan.falloff != falloff:
+            self.plan = get_plan(self.losRadius, decayPercent, falloff)
+            self.gridDeltas = self.plan.deltas(self.side)
+            # plan index of each window cell (-1 for cells outside the los radius)
+            self.gridToPlan = array('i', [-1]) * (self.side*self.side)
+            for i,delta in enumerate(self.gridDeltas):
+                self.gridToPlan[self.center + delta] = i
+            self.reusable = False
+        if self.reusable and inside and max(abs(viewerPos.x - self.viewerPos.x), abs(viewerPos.y - self.viewerPos.y)) <= self.maxStep:
+            self.__update_incremental(viewerPos)
+        else:
+            self.__update_full(viewerPos, inside)
+        self.viewerPos = viewerPos
+        self.window.origin = (viewerPos.x - r, viewerPos.y - r)
+        return self
+
+    def __window_row(self, viewerPos, j):
+        # the visibility of row j of the window around the viewer (fully in the map), as an array like the snapshot
+        m = self.visibilityMap
+        start = (viewerPos.x - self.half) + (viewerPos.y - self.half + j)*m.width
+        row = m.data[start : start + self.side]
+        return row if isinstance(row, array) else array(self.snapshot.typecode, row)
+
+    def __update_band_max(self, band, end):
+        # the farthest visible point of a band (only looking at the plan points before end)
+        (s,e) = self.plan.bands[band]
+        values = self.values
+        center = self.center
+        gridDeltas = self.gridDeltas
+        dist = self.plan.dist
+        farthest = 0.0
+        # the points are sorted by distance, so scan backwards for the first visible one
+        for i in range(min(e, end)-1, s-1, -1):
+            if values[center + gridDeltas[i]] > 0:
+                farthest = dist[i]
+                break
+        self.bandMax[band] = farthest
+
+    def __update_full(self, viewerPos, inside):
+        self.fullUpdates += 1
+        self.window.reset(viewerPos)
+        self.end = self.plan.run_into(viewerPos, self.visibilityMap, self.values, self.center, self.side)
+        self.bandMax = [0.0] * len(self.plan.bands)
+        for band in range(len(self.plan.bands)):
+            self.__update_band_max(band, self.end)
+        self.reusable = inside
+        if inside:
+            S = self.side
+            for j in range(S):
+                self.snapshot[j*S:(j+1)*S] = self.__window_row(viewerPos, j)
+
+    def __update_incremental(self, viewerPos):
+        plan = self.plan
+        S = self.side
+        center = self.center
+        gridDeltas = self.gridDeltas
+        values = self.values
+        snapshot = self.snapshot
+        oldEnd = self.end
+
+        # 1. The offsets whose visibility differs between the old frame (snapshot) and the new one. Compare whole rows
+        #    first (in C), and only look at the cells of rows that differ. Then update the snapshot to the new frame
+        changed = []
+        for j in range(S):
+            row = self.__window_row(viewerPos, j)
+            old = snapshot[j*S:(j+1)*S]
+            if row != old:
+                changed.extend( [j*S + k for k in range(S) if row[k] != old[k]])
+                snapshot[j*S:(j+1)*S] = row
+
+        # 2. Everything downstream of a changed offset is dirty (the changed offsets themselves only propagate differently).
+        #    Recomputing a dirty point costs more than a point of a full run, so past a budget a full run is cheaper
+        gridToPlan = self.gridToPlan
+        budget = int(oldEnd * self.maxDirtyRatio)
+        marked = bytearray(plan.size)
+        dirty = []
+        pending = [ gridToPlan[g] for g in changed if gridToPlan[g] >= 0]
+        children = plan.children
+        while pending:
+            for c in children[pending.pop()]:
+                if c < oldEnd and not marked[c]:
+                    marked[c] = 1
+                    dirty.append(c)
+                    pending.append(c)
+            if len(dirty) > budget:
+                self.__update_full(viewerPos, True)
+                return
+        self.incrementalUpdates += 1
+        self.recomputedPoints += len(dirty)
+        dirty.sort()
+
+        # 3. Go through the bands in order: recompute the dirty points, compute the points past the previous early exit,
+        #    and find the new early exit
+        nb0 = plan.nb0
+        nb1 = plan.nb1
+        u = plan.u
+        t = plan.t
+        prevDecay = plan.prevDecay
+        decay = plan.decay
+        dist = plan.dist
+        def compute(i):
+            ga = center + gridDeltas[nb0[i]]
+            gb = center + gridDeltas[nb1[i]]
+            amt = u[i]*(snapshot[ga]*values[ga]) + t[i]*(snapshot[gb]*values[gb])
+            values[center + gridDeltas[i]] = max(amt + prevDecay[i] - decay[i], 0.0)
+
+        newEnd = plan.size
+        computedEnd = oldEnd
+        maxRadiusUsed = 0.0
+        d = 0
+        for band in range(1, len(plan.bands)):
+            (s,e) = plan.bands[band]
+            touched = False
+            while d < len(dirty) and dirty[d] < e:
+                compute(dirty[d])
+                d += 1
+                touched = True
+            if e > computedEnd:
+                for i in range(max(s, computedEnd), e):
+                    compute(i)
+                computedEnd = e
+                touched = True
+            if touched or e > oldEnd:
+                self.__update_band_max(band, e)
+            # if we've made a full round in the sorted points spiral without adding a tile, early exit
+            if dist[e-1] - maxRadiusUsed >= 2.0:
+                farthest = maxRadiusUsed
+                for i in range(s, e):
+                    if dist[i] - farthest >= 2.0:
+                        newEnd = i
+                        break
+                    if values[center + gridDeltas[i]] > 0:
+                        farthest = dist[i]
+                if newEnd < plan.size:
+                    break
+            maxRadiusUsed = max(maxRadiusUsed, self.bandMax[band])
+
+        # points past the early exit are not visible
+        for i in range(newEnd, max(oldEnd, computedEnd)):
+            values[center + gridDeltas[i]] = 0.0
+        self.end = newEnd
@@ -0,0 +1,99 @@
+import math
+
+"""
+    Spatial index of live FoV results, to find the ones invalidated by map edits
+
+    A FoV only depends on the visibility of the tiles within its los radius: a disk for the spiral and rhombus
+    engines, a square for the permissive engine. The index buckets each registered FoV in the grid cells that its
+    area's bounding box overlaps, so a query only tests the FoVs of the cells that the edited rectangle overlaps,
+    with an exact area/rectangle test.
+
+    Typical use, with a VersionedMap2D:
+        index.add(npc, npc.pos, losRadius)
+        ...edit the map...
+        for npc in index.invalidated(visibilityMap):
+            recompute the fov of npc
+"""
+
+class FovIndex(object):
+    """
+        Grid of live FoVs, each registered with a key (any hashable, e.g. the viewer object or an id)
+        cellSize: size of the grid cells, in tiles. Roughly the typical los radius works well
+    """
+    def __init__(self, cellSize = 16):
+        self.cellSize = cellSize
+        self.entries = {} # key -> (vx, vy, losRadius, square, cells)
+        self.cells = {} # (cx,cy) -> set of keys
+        self.seen = {} # id(map) -> (map, version): the edits of each map already returned by invalidated()
+        
+    def __len__(self):
+        return len(self.entries)
+        
+    def __contains__(self, key):
+        return key in self.entries
+        
+    def add(self, key, viewerPos, losRadius, algorithm = 'fov_rho'):
+        # register (or move) the FoV of key. algorithm is the engine module name (fov_permissive covers a square)
+        self.remove(key)
+        r = int(math.ceil(losRadius))
+        cs = self.cellSize
+        cells = [ (cx,cy) for cy in range((viewerPos.y-r)//cs, (viewerPos.y+r)//cs+1)
+                          for cx in range((viewerPos.x-r)//cs, (viewerPos.x+r)//cs+1)]
+        for c in cells:
+            bucket = self.cells.get(c)
+            if bucket is None:
+                bucket = self.cells[c] = set()
+            bucket.add(key)
+        self.entries[key] = (viewerPos.x, viewerPos.y, losRadius, algorithm == 'fov_permissive', cells)
+        
+    def remove(self, key):
+        # unregister the FoV of key, if present
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for c in entry[4]:
+            bucket = self.cells[c]
+            bucket.discard(key)
+            if not bucket:
+                del self.cells[c]
+                
+    def overlaps(self, key, x0, y0, x1, y1):
+        # if the area of the FoV of key overlaps any tile of the rectangle [x0,x1) x [y0,y1)
+        (vx, vy, losRadius, square, cells) = self.entries[key]
+        # offset from the viewer to the closest tile of the rectangle
+        dx = max(x0 - vx, 0, vx - (x1-1))
+        dy = max(y0 - vy, 0, vy - (y1-1))
+        if square:
+            return max(dx,dy) <= losRadius
+        return dx*dx + dy*dy <= losRadius*losRadius
+        
+    def query(self, x0, y0, x1, y1):
+        # the keys of the FoVs whose area overlaps the rectangle [x0,x1) x [y0,y1)
+        cs = self.cellSize
+        candidates = set()
+        for cy in range(y0//cs, (y1-1)//cs+1):
+            for cx in range(x0//cs, (x1-1)//cs+1):
+                bucket = self.cells.get((cx,cy))
+                if bucket:
+                    candidates.update(bucket)
+        return set( key for key in candidates if self.overlaps(key, x0, y0, x1, y1))
+        
+    def query_rects(self, rects):
+        # the keys of the FoVs whose area overlaps any of the rectangles
+        keys = set()
+        for (x0,y0,x1,y1) in rects:
+            keys.update(self.query(x0,y0,x1,y1))
+        return keys
+        
+    def follow(self, visibilityMap):
+        # start following the edits of a VersionedMap2D from now: invalidated() won't return older edits
+        self.seen[id(visibilityMap)] = (visibilityMap, visibilityMap.version)
+        
+    def invalidated(self, visibilityMap):
+        # the keys of the FoVs invalidated by the edits of a VersionedMap2D since the last call (for that map), or
+        # since follow(). A map that isn't followed yet gets all its recorded edits
+        # The map's edits aren't consumed, so other indices (or anything else) can follow the same map
+        seen = self.seen.get(id(visibilityMap))
+        version = seen[1] if seen is not None and seen[0] is visibilityMap else 0
+        self.seen[id(visibilityMap)] = (visibilityMap, visibilityMap.version)
+        return self.query_rects(visibilityMap.dirty_since(version))
@@ -0,0 +1,193 @@
+import importlib
+from array import array
+from mathutil import *
+from fov_plan import get_plan
+from fov_index import FovIndex
+import fov_spiral_buggy
+
+"""
+    Light maps: the combined illumination of many lights, each a "viewer" with a radius, an intensity and a decay
+
+    Every light keeps its FoV (a FovWindow), and the illumination buffer holds the combination of all of them, the
+    sum (mode 'add') or the max (mode 'max') of intensity*fov, so reading the light at a tile is a lookup. When a light
+    moves, changes, or a wall within its radius changes, only that light is recomputed:
+        - 'add': its old contribution is subtracted from its window's area of the buffer, and the new one added
+        - 'max': a max can't be subtracted, so its old window's area is recombined from the other lights that
+          overlap it (found with a FovIndex), then the new contribution is maxed in
+    The combinations are vectorized with NumPy (on 2D views of the buffer and the windows), and run row by row
+    without it, with the same results.
+    Subtracting and re-adding can leave rounding residue in 'add' mode (the buffer is clamped at 0); rebuild()
+    recombines the whole buffer from the cached FoVs.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Light(object):
+    """
+        A light of a LightMap: position, radius, intensity (scale of its FoV values), decay (None: the engine's),
+        and window, its cached FoV
+    """
+    def __init__(self, pos, losRadius, intensity = 1.0, decayPercent = None):
+        self.pos = pos
+        self.losRadius = losRadius
+        self.intensity = intensity
+        self.decayPercent = decayPercent
+        self.window = None
+
+class LightMap(object):
+    """
+        Illumination of a visibility map by a set of lights, each registered with a key (any hashable)
+        mode: 'add' (lights sum up) or 'max' (the brightest light wins)
+        algorithm: the engine module of the lights' FoVs (e.g. 'fov_rho'). Per-light decay needs the spiral engine
+                   ('fov_spiral_buggy'), the other engines use their own decay
+        illumination: the combined light, a Map2D of the map's size
+        Counters: updates (light FoVs computed)
+    """
+    def __init__(self, visibilityMap, mode = 'add', algorithm = 'fov_rho', cellSize = 16):
+        assert mode in ('add', 'max'), "unknown light mode: " + mode
+        self.visibilityMap = visibilityMap
+        self.mode = mode
+        self.algorithm = algorithm
+        self.module = importlib.import_module(algorithm)
+        self.illumination = Map2D(visibilityMap.width, visibilityMap.height, 0.0)
+        self.lights = {}
+        self.index = FovIndex(cellSize) # the lights' areas, to find the lights affected by map edits (and 'max' overlaps)
+        if hasattr(visibilityMap, 'version'):
+            # the lights are computed on the map as it is now
+            self.index.follow(visibilityMap)
+        self.updates = 0
+
+    def __len__(self):
+        return len(self.lights)
+
+    def __contains__(self, key):
+        return key in self.lights
+
+    def get(self, point):
+        return self.illumination.get(point)
+
+    def add_light(self, key, pos, losRadius, intensity = 1.0, decayPercent = None):
+        # add a light (or replace the light of key). Returns the Light
+        self.remove_light(key)
+        light = self.lights[key] = Light(pos, losRadius, intensity, decayPercent)
+        self.__compute(light)
+        self.index.add(key, pos, losRadius, self.algorithm)
+        self.__combine(light, 'max' if self.mode == 'max' else 'add')
+        return light
+
+    def remove_light(self, key):
+        # remove the light of key, if present, and its contribution
+        light = self.lights.pop(key, None)
+        if light is None:
+            return
+        self.index.remove(key)
+        self.__take_out(light)
+
+    def move_light(self, key, pos = None, losRadius = None, intensity = None, decayPercent = None):
+        # move and/or change the light of key (None: unchanged), updating only its contribution
+        light = self.lights[key]
+        self.__take_out(light, key)
+        light.pos = light.pos if pos is None else pos
+        light.losRadius = light.losRadius if losRadius is None else losRadius
+        light.intensity = light.intensity if intensity is None else intensity
+        light.decayPercent = light.decayPercent if decayPercent is None else decayPercent
+        self.__compute(light)
+        self.index.add(key, light.pos, light.losRadius, self.algorithm)
+        self.__combine(light, 'max' if self.mode == 'max' else 'add')
+
+    def map_changed(self, rects = None):
+        """
+        Update the lights affected by edits of the visibility map: the rectangles (x0,y0,x1,y1), end-exclusive,
+        or by default the edits of a VersionedMap2D since the last call (see FovIndex.invalidated)
+        Returns the keys of the updated lights
+        """
+        keys = self.index.invalidated(self.visibilityMap) if rects is None else self.index.query_rects(rects)
+        for key in keys:
+            self.move_light(key)
+        return keys
+
+    def rebuild(self):
+        # recombine the whole buffer from the cached FoVs of the lights (e.g. to drop the rounding residue of 'add')
+        data = self.illumination.data
+        data[:] = array('d', [0.0]) * len(data)
+        op = 'max' if self.mode == 'max' else 'add'
+        for light in self.lights.values():
+            self.__combine(light, op)
+
+    def __compute(self, light):
+        # (re)compute the FoV of a light, reusing its window
+        self.updates += 1
+        if light.decayPercent is None:
+            light.window = self.module.fov(light.pos, light.losRadius, self.visibilityMap, out = light.window)
+            return
+        assert self.algorithm == 'fov_spiral_buggy', "per-light decay needs the spiral engine"
+        light.window = FovWindow.reuse(light.window, light.pos, light.losRadius)
+        get_plan(light.losRadius, light.decayPercent, fov_spiral_buggy.DECAY_FALLOFF).run(light.pos, self.visibilityMap, light.window)
+
+    def __take_out(self, light, key = None):
+        # remove the current contribution of a light from the buffer. key: the light's key, if it's still indexed
+        if self.mode == 'add':
+            self.__combine(light, 'sub')
+            return
+        # recombine the light's area from the other lights that overlap it
+        rect = self.__rect(light.window)
+        (x0, y0, x1, y1) = rect
+        if x0 >= x1 or y0 >= y1:
+            return
+        self.__clear(rect)
+        for other in self.index.query(x0, y0, x1, y1):
+            if other != key:
+                self.__combine(self.lights[other], 'max', rect)
+
+    def __clear(self, rect):
+        # set the buffer to 0 in the rectangle
+        (x0, y0, x1, y1) = rect
+        w = self.illumination.width
+        row = array('d', [0.0]) * (x1-x0)
+        for y in range(y0, y1):
+            self.illumination.data[x0 + y*w : x1 + y*w] = row
+
+    def __rect(self, window, clip = None):
+        # the area of a window on the map, (x0,y0,x1,y1) end-exclusive, clipped to the map (and to clip)
+        (ox, oy) = window.origin
+        (x0, y0, x1, y1) = (0, 0, self.illumination.width, self.illumination.height) if clip is None else clip
+        return (max(ox, x0), max(oy, y0), min(ox + window.width, x1), min(oy + window.height, y1))
+
+    def __combine(self, light, op, clip = None):
+        # combine the contribution of a light into the buffer, in its window's area (clipped to clip):
+        # op: 'add', 'sub' (clamped at 0) or 'max'
+        window = light.window
+        (x0, y0, x1, y1) = self.__rect(window, clip)
+        if x0 >= x1 or y0 >= y1:
+            return
+        (ox, oy) = window.origin
+        k = light.intensity
+        w = self.illumination.width
+        if np is not None:
+            dst = np.frombuffer(self.illumination.data, dtype=np.float64).reshape(-1, w)[y0:y1, x0:x1]
+            src = k * np.frombuffer(window.data, dtype=np.float64).reshape(-1, window.width)[y0-oy:y1-oy, x0-ox:x1-ox]
+            if op == 'add':
+                dst += src
+            elif op == 'sub':
+                dst -= src
+                np.maximum(dst, 0.0, out=dst)
+            else:
+                np.maximum(dst, src, out=dst)
+            return
+        data = self.illumination.data
+        wdata = window.data
+        n = x1-x0
+        for y in range(y0, y1):
+            a = x0 + y*w
+            b = (x0-ox) + (y-oy)*window.width
+            src = [ k*v for v in wdata[b:b+n]]
+            if op == 'add':
+                row = [ d + s for (d,s) in zip(data[a:a+n], src)]
+            elif op == 'sub':
+                row = [ max(d - s, 0.0) for (d,s) in zip(data[a:a+n], src)]
+            else:
+                row = [ max(d, s) for (d,s) in zip(data[a:a+n], src)]
+            data[a:a+n] = array('d', row)
@@ -0,0 +1,226 @@
+import math
+from mathutil import *
+from fov_plan import get_plan
+import fov_spiral_buggy
+import fov_rho as fov_rho_scalar
+
+"""
+    Vectorized (NumPy) variants of the FoV engines. NumPy is optional: without it, every engine here falls back
+    to the equivalent pure-python engine, with identical results.
+
+    fov_spiral: the spiral engine evaluated one band of the spiral at a time. In the spiral order every point depends
+        only on neighbours strictly closer to the origin, so all points of a band (see FovPlan.bands) are computed
+        at once, with gathered neighbour values and vectorized lerp and decay.
+
+    fov_rho: the rhombus engine swept one column at a time, for all 8 octants together. In fov_rho.fov, cell (col,row)
+        only writes to (col+1,row) and (col+1,row+1), so a column only depends on the previous one. Everything that
+        depends only on (col,row) (contributions, calc_idx selections, octant offsets) is in precomputed tables.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def map_array(m):
+    # flat numpy view of a Map2D's storage (zero-copy for the typed storage)
+    if isinstance(m.data, list):
+        return np.asarray(m.data, dtype=np.float64)
+    return np.frombuffer(m.data, dtype=memoryview(m.data).format)
+
+def spiral_values( plan, viewers, visibilityMap):
+    """
+    Run the spiral engine for a batch of viewers at once (the viewer axis is vectorized too)
+    Returns (vals, px, py, inb): the visibility of each plan point for each viewer (V x plan.size), the absolute
+    positions of the points, and which of them are in the map. Points after the early exit, or off the map, are 0
+    """
+    w = visibilityMap.width
+    h = visibilityMap.height
+    arr = plan.as_numpy()
+    vxs = np.array([p.x for p in viewers]).reshape(-1,1)
+    vys = np.array([p.y for p in viewers]).reshape(-1,1)
+
+    # absolute positions of all plan points, and which of them are in the map
+    px = arr['ox'] + vxs
+    py = arr['oy'] + vys
+    inb = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+    vis = np.zeros(px.shape)
+    vis[inb] = map_array(visibilityMap)[(px + py*w)[inb]]
+
+    # visibility propagated FROM each point: "visibility at tile" * "visibility propagation so far"
+    vals = np.zeros(px.shape)
+    prop = np.zeros(px.shape)
+    vals[:,0] = 1
+    prop[:,0] = vis[:,0]
+
+    nb0 = arr['nb0']
+    nb1 = arr['nb1']
+    u = arr['u']
+    t = arr['t']
+    prevDecay = arr['prevDecay']
+    decay = arr['decay']
+    dist = arr['dist']
+
+    maxRadiusUsed = np.zeros(len(viewers)) # Keep track of the max radius we've processed so far, per viewer
+    alive = np.ones(len(viewers), dtype=bool) # viewers that haven't early-exited yet
+    for (s,e) in plan.bands[1:]:
+        amt = u[s:e]*prop[:,nb0[s:e]] + t[s:e]*prop[:,nb1[s:e]]
+        amt = np.maximum(amt + prevDecay[s:e] - decay[s:e], 0.0)
+        amt[~inb[:,s:e]] = 0.0
+        amt[~alive] = 0.0
+
+        # if we've made a full round in the sorted points spiral without adding a tile, early exit.
+        # Same condition as the scalar engine, checked for each in-map point against the farthest visible point before it
+        # (only needed if the band reaches 2 units past the farthest visible point so far)
+        d = dist[s:e]
+        if np.any(alive & (d[-1] - maxRadiusUsed >= 2.0)):
+            seen = np.where(amt > 0, d, 0.0)
+            farthest = np.maximum.accumulate(np.concatenate((maxRadiusUsed.reshape(-1,1), seen[:,:-1]), axis=1), axis=1)
+            stop = inb[:,s:e] & (d - farthest >= 2.0)
+            stop[~alive] = False
+            stopped = np.flatnonzero(stop.any(axis=1))
+            if stopped.size:
+                k = np.argmax(stop[stopped], axis=1)
+                amt[stopped] *= np.arange(e-s) < k.reshape(-1,1)
+                alive[stopped] = False
+
+        vals[:,s:e] = amt
+        prop[:,s:e] = amt * vis[:,s:e]
+        maxRadiusUsed = np.maximum(maxRadiusUsed, np.max(np.where(amt > 0, d, 0.0), axis=1))
+        if not alive.any():
+            break
+
+    return (vals, px, py, inb)
+
+def fov_spiral( viewerPos, losRadius, visibilityMap, decayPercent = None, out = None, falloff = None):
+    """
+    Calculate the field-of-vision map of the spiral engine (same results as fov_spiral_buggy.fov, within float tolerance)
+    decayPercent, falloff: default to fov_spiral_buggy.DECAY_PER_TILE_PERCENT and DECAY_FALLOFF
+    out: optional FovWindow to reuse. Returns a FovWindow
+    """
+    if decayPercent is None:
+        decayPercent = fov_spiral_buggy.DECAY_PER_TILE_PERCENT
+    if falloff is None:
+        falloff = fov_spiral_buggy.DECAY_FALLOFF
+    plan = get_plan(losRadius, decayPercent, falloff)
+    fovmap = FovWindow.reuse(out, viewerPos, losRadius)
+    if np is None:
+        return plan.run(viewerPos, visibilityMap, fovmap)
+    vals, px, py, inb = spiral_values(plan, [viewerPos], visibilityMap)
+    __scatter(fovmap, vals, px, py, inb)
+    return fovmap
+
+class RhoTables(object):
+    """
+        Viewer- and map-independent tables for the column sweep of fov_rho, indexed [col,row] (and [octant,col,row]),
+        for a source cell (col,row) that propagates to (col+1,row+1) (diagonal) and (col+1,row) (straight)
+            contribDiag, contribStraight: contribution factors of the propagated value
+            selDiag, selStraight:         True where calc_idx picks the straight (1) incoming value of the source cell
+            ox, oy:                       offsets of the cell in each octant of fov_rho.axis_sets
+            distSquared:                  squared distance of the cell to the viewer
+    """
+    def __init__(self, rmax):
+        self.rmax = rmax
+        col = np.arange(rmax).reshape(-1,1)
+        row = np.arange(rmax).reshape(1,-1)
+        # expand the shared flat tables of fov_rho (cell (col,row) at col*(col+1)//2 + row) to [col,row] matrices
+        flat = fov_rho_scalar.rho_tables(rmax)
+        octant = row <= col
+        tri = (col*(col+1)//2 + row)[octant]
+        self.contribDiag = np.zeros((rmax,rmax))
+        self.contribStraight = np.zeros((rmax,rmax))
+        self.selDiag = np.zeros((rmax,rmax), dtype=bool)
+        self.selStraight = np.zeros((rmax,rmax), dtype=bool)
+        self.contribDiag[octant] = np.frombuffer(flat.contribDiag, dtype=np.float64)[tri]
+        self.contribStraight[octant] = np.frombuffer(flat.contribStraight, dtype=np.float64)[tri]
+        self.selDiag[octant] = np.frombuffer(flat.selDiag, dtype=np.int8)[tri] == 1
+        self.selStraight[octant] = np.frombuffer(flat.selStraight, dtype=np.int8)[tri] == 1
+        self.ox = np.array([ fwd.x*col + up.x*row for (fwd,up) in fov_rho_scalar.axis_sets])
+        self.oy = np.array([ fwd.y*col + up.y*row for (fwd,up) in fov_rho_scalar.axis_sets])
+        self.distSquared = col*col + row*row
+        # cells of the octant: row <= col
+        self.octant = octant
+
+__rho_tables = None
+def rho_tables(rmax):
+    # tables for at least rmax columns; rebuilt only when a larger radius is requested (smaller ones use slices)
+    global __rho_tables
+    if __rho_tables is None or __rho_tables.rmax < rmax:
+        __rho_tables = RhoTables(rmax)
+    return __rho_tables
+
+def rho_values( viewers, losRadius, visibilityMap):
+    """
+    Run the rhombus engine for a batch of viewers at once (the viewer axis is vectorized too)
+    Returns (vals, px, py, valid): the visibility of each octant cell for each viewer (V x 8 x rmax x rmax, indexed
+    [viewer,octant,col,row]), the absolute positions of the cells, and which of them are in the map and within los.
+    Invalid cells are 0. The line cells are shared by two octants and have the same value in both
+    """
+    w = visibilityMap.width
+    h = visibilityMap.height
+    rmax = math.ceil(losRadius)+1
+    tables = rho_tables(rmax)
+    count = len(viewers)
+    vxs = np.array([p.x for p in viewers]).reshape(-1,1,1,1)
+    vys = np.array([p.y for p in viewers]).reshape(-1,1,1,1)
+
+    # absolute positions of all octant cells, and which of them are in the map and within the los radius
+    px = tables.ox[:,:rmax,:rmax] + vxs
+    py = tables.oy[:,:rmax,:rmax] + vys
+    valid = (px >= 0) & (px < w) & (py >= 0) & (py < h) & (tables.distSquared[:rmax,:rmax] <= losRadius*losRadius) & tables.octant[:rmax,:rmax]
+    vis = np.zeros(px.shape)
+    vis[valid] = map_array(visibilityMap)[(px + py*w)[valid]]
+
+    # the diagonals/straight lines: visibility propagates multiplicatively along the ray (only for in-map cells within los)
+    diag = np.arange(rmax)
+    straightLine = np.ones((count,8,rmax))
+    diagLine = np.ones((count,8,rmax))
+    straightLine[:,:,1:] = np.cumprod(vis[:,:,:-1,0], axis=2)
+    diagLine[:,:,1:] = np.cumprod(vis[:,:,diag[:-1],diag[:-1]], axis=2)
+    straightLine *= valid[:,:,:,0]
+    diagLine *= valid[:,:,diag,diag]
+
+    # Sweep the columns. Each column stores the diagonal and straight incoming values of its cells (rows);
+    # the line cells (row 0 and row == col) store their line value in both
+    vals = np.zeros(px.shape)
+    curDiag = np.zeros((count,8,rmax))
+    curStraight = np.zeros((count,8,rmax))
+    nextDiag = np.zeros((count,8,rmax))
+    nextStraight = np.zeros((count,8,rmax))
+    for c in range(1,rmax-1):
+        curDiag[:,:,0] = curStraight[:,:,0] = straightLine[:,:,c]
+        curDiag[:,:,c] = curStraight[:,:,c] = diagLine[:,:,c]
+        vc = vis[:,:,c,:c+1]
+        # (c,r) -> (c+1,r+1), for rows 0..c-1
+        src = np.where(tables.selDiag[c,:c], curStraight[:,:,:c], curDiag[:,:,:c])
+        nextDiag[:,:,1:c+1] = src * (tables.contribDiag[c,:c] * vc[:,:,:c])
+        # (c,r) -> (c+1,r), for rows 1..c
+        src = np.where(tables.selStraight[c,1:c+1], curStraight[:,:,1:c+1], curDiag[:,:,1:c+1])
+        nextStraight[:,:,1:c+1] = src * (tables.contribStraight[c,1:c+1] * vc[:,:,1:c+1])
+        vals[:,:,c+1,1:c+1] = nextDiag[:,:,1:c+1] + nextStraight[:,:,1:c+1]
+        curDiag, nextDiag = nextDiag, curDiag
+        curStraight, nextStraight = nextStraight, curStraight
+
+    # fov_rho.fov has no decay (decayPerTile is forced to 0), so the values are used as they are
+    np.maximum(vals, 0, out=vals)
+    vals[:,:,:,0] = straightLine
+    vals[:,:,diag,diag] = diagLine
+    vals *= valid
+    return (vals, px, py, valid)
+
+def fov_rho( viewerPos, losRadius, visibilityMap, out = None):
+    """
+    Calculate the field-of-vision map of the rhombus engine (numerically equivalent to fov_rho.fov)
+    out: optional FovWindow to reuse. Returns a FovWindow
+    """
+    if np is None:
+        return fov_rho_scalar.fov(viewerPos, losRadius, visibilityMap, out = out)
+    fovmap = FovWindow.reuse(out, viewerPos, losRadius)
+    vals, px, py, valid = rho_values([viewerPos], losRadius, visibilityMap)
+    __scatter(fovmap, vals, px, py, valid)
+    return fovmap
+
+def __scatter( fovmap, vals, px, py, mask):
+    # write the values of a single viewer, at absolute positions (px,py), to its FovWindow
+    local = (px - fovmap.origin[0]) + (py - fovmap.origin[1])*fovmap.width
+    np.frombuffer(fovmap.data, dtype=np.float64)[local[mask]] = vals[mask]
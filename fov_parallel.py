@@ -0,0 +1,125 @@
+import math
+import os
+from array import array
+from multiprocessing import get_context, shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from mathutil import *
+import fov_batch
+import fov_rho
+import fov_spiral_buggy
+
+"""
+    Process-pool parallel FoV for large batches of viewers (python threads don't help the pure-python engines)
+
+    The visibility map is copied ONCE into shared memory, and every worker process maps it as a Map2D. Each call fans
+    chunks of viewers out to the workers, which run fov_batch.fov_many and write their results straight into a shared
+    output buffer, so neither the maps nor the results are ever pickled. Only viewer coordinates and chunk offsets are.
+"""
+
+# Per-worker state: the shared visibility map, and the output buffers attached so far (by name)
+_worker_map = None
+_worker_outputs = {}
+
+def _worker_init(mapName, width, height, typecode):
+    global _worker_map
+    shm = shared_memory.SharedMemory(name=mapName)
+    nbytes = width*height*array(typecode).itemsize
+    _worker_map = (shm, Map2D.from_buffer(width, height, shm.buf[:nbytes].cast(typecode)))
+
+def _worker_run(outName, viewers, start, losRadius, algorithm, window, decays):
+    # compute the viewers [start, start+len(viewers)) of the batch, into the shared output stack
+    (fov_rho.DECAY_PER_TILE_PERCENT, fov_spiral_buggy.DECAY_PER_TILE_PERCENT, fov_rho.DECAY_FALLOFF, fov_spiral_buggy.DECAY_FALLOFF) = decays
+    visibilityMap = _worker_map[1]
+    shm = _worker_outputs.get(outName)
+    if shm is None:
+        # output buffers are replaced when a larger one is needed, so only keep the current one attached
+        for old in _worker_outputs.values():
+            old.close()
+        _worker_outputs.clear()
+        shm = shared_memory.SharedMemory(name=outName)
+        _worker_outputs[outName] = shm
+    half = int(math.ceil(losRadius))
+    width = 2*half+1 if window else visibilityMap.width
+    height = 2*half+1 if window else visibilityMap.height
+    size = width*height
+    count = len(viewers)
+    data = shm.buf[start*size*8:(start+count)*size*8].cast('d')
+    out = fov_batch.FovStack(count, width, height, data)
+    fov_batch.fov_many([ivec2(x,y) for (x,y) in viewers], losRadius, visibilityMap, algorithm, window, out)
+    return count
+
+class ParallelFov(object):
+    """
+        A pool of worker processes computing FoV batches against one visibility map (in shared memory)
+        Usage:
+            with ParallelFov(visibilityMap) as pfov:
+                stack = pfov.fov_many(viewers, losRadius, 'fov_rho')
+        If the visibility map is edited, call update_map() before the next batch
+    """
+    def __init__(self, visibilityMap, workers = None, mp_context = None):
+        self.visibilityMap = visibilityMap
+        self.workers = workers or os.cpu_count() or 1
+        view = memoryview(visibilityMap.data)
+        self.typecode = view.format
+        self.__map_shm = shared_memory.SharedMemory(create=True, size=max(1, view.nbytes))
+        self.__out_shm = None
+        self.update_map()
+        self.__pool = ProcessPoolExecutor( self.workers, mp_context = mp_context or get_context(),
+            initializer = _worker_init, initargs = (self.__map_shm.name, visibilityMap.width, visibilityMap.height, self.typecode))
+
+    def update_map(self):
+        # copy the (edited) visibility map to the shared memory
+        view = memoryview(self.visibilityMap.data).cast('B')
+        self.__map_shm.buf[:view.nbytes] = view
+
+    def fov_many(self, viewers, losRadius, algorithm = 'fov_rho', window = True, out = None, chunk = None):
+        """
+        Same as fov_batch.fov_many, but the viewers are split in chunks that run on the worker processes
+        chunk: number of viewers per task (default: enough for ~4 tasks per worker)
+        """
+        half = int(math.ceil(losRadius))
+        width = 2*half+1 if window else self.visibilityMap.width
+        height = 2*half+1 if window else self.visibilityMap.height
+        count = len(viewers)
+        if count == 0:
+            return fov_batch.FovStack(0, width, height)
+        nbytes = count*width*height*8
+        if self.__out_shm is None or self.__out_shm.size < nbytes:
+            self.__release_output()
+            self.__out_shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        # the engines only write the cells they visit, so the output starts 0-initialised
+        self.__out_shm.buf[:nbytes] = bytes(nbytes)
+
+        if chunk is None:
+            chunk = max(1, math.ceil(count / (4*self.workers)))
+        coords = [(p.x,p.y) for p in viewers]
+        decays = (fov_rho.DECAY_PER_TILE_PERCENT, fov_spiral_buggy.DECAY_PER_TILE_PERCENT, fov_rho.DECAY_FALLOFF, fov_spiral_buggy.DECAY_FALLOFF)
+        tasks = [ self.__pool.submit(_worker_run, self.__out_shm.name, coords[start:start+chunk], start,
+                                     losRadius, algorithm, window, decays) for start in range(0, count, chunk)]
+        for task in tasks:
+            task.result()
+
+        # collect the shared output into the result stack (a single copy)
+        if out is None or out.count != count or out.width != width or out.height != height:
+            out = fov_batch.FovStack(count, width, height)
+        out.origins = [ (p.x-half, p.y-half) if window else (0,0) for p in viewers]
+        memoryview(out.data).cast('B')[:nbytes] = self.__out_shm.buf[:nbytes]
+        return out
+
+    def __release_output(self):
+        if self.__out_shm is not None:
+            self.__out_shm.close()
+            self.__out_shm.unlink()
+            self.__out_shm = None
+
+    def close(self):
+        self.__pool.shutdown()
+        self.__release_output()
+        self.__map_shm.close()
+        self.__map_shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
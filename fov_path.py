@@ -0,0 +1,157 @@
+import sys
+import mmap
+import math
+import struct
+import importlib
+from array import array
+from mathutil import *
+import fov_rho
+from fov_incremental import IncrementalFov
+
+"""
+    Streaming FoV along a viewer path (e.g. the '@' tiles of a map, see fov_demoutil.load_from_file)
+
+    fov_along_path yields the FoV of each step as it goes, reusing one result window and the engine's state between
+    consecutive positions (the rhombus engine's working buffers, or an IncrementalFov for the spiral engine, which
+    only recomputes what a one-tile move changes), so a path of any length runs in constant memory.
+
+    The results can be streamed to disk (write_stream) as fixed-size frames, and read back with FovStream, which
+    memory-maps the file and returns zero-copy windows, in order or by step. File layout (little-endian):
+        header: magic (8 bytes), losRadius (double), number of frames (uint32), typecode (1 byte), 3 bytes padding
+        frame:  viewer x, y (int32), then the (2r+1)^2 window values of the typecode, row by row
+"""
+
+STREAM_MAGIC = b'FOVSTRM1'
+_HEADER = struct.Struct('<8sdIc3x')
+_FRAME_POS = struct.Struct('<ii')
+
+def walk_order(points):
+    """
+    Order a set of path tiles as a walk: start at an end of the path (a tile with a single neighbour, if any) and
+    repeatedly step to the closest unvisited tile (adjacent ones first). Returns a list of the points
+    """
+    remaining = { (p.x,p.y) for p in points}
+    if not remaining:
+        return []
+    def neighbours(x, y):
+        return [ (x+dx,y+dy) for dy in (-1,0,1) for dx in (-1,0,1) if (dx or dy) and (x+dx,y+dy) in remaining]
+    ends = [ q for q in sorted(remaining, key=lambda q: (q[1],q[0])) if len(neighbours(*q)) == 1]
+    cur = ends[0] if ends else min(remaining, key=lambda q: (q[1],q[0]))
+    walk = []
+    while True:
+        remaining.discard(cur)
+        walk.append(ivec2(*cur))
+        if not remaining:
+            return walk
+        nbs = neighbours(*cur)
+        # prefer straight steps to diagonal ones, then the closest tile anywhere (jump over gaps)
+        if nbs:
+            cur = min(nbs, key=lambda q: abs(q[0]-cur[0]) + abs(q[1]-cur[1]))
+        else:
+            cur = min(remaining, key=lambda q: (q[0]-cur[0])**2 + (q[1]-cur[1])**2)
+
+def fov_along_path(path, losRadius, visibilityMap, algorithm = 'fov_rho'):
+    """
+    Generator: the FoV of each position of the path, with the fov() of an engine module (e.g. 'fov_rho')
+    Yields (viewerPos, fovWindow). The window is reused for the next step, so copy it (or write it out) to keep it
+    """
+    if algorithm == 'fov_spiral_buggy':
+        # consecutive positions are usually adjacent, so most of the previous result can be reused
+        incremental = IncrementalFov(losRadius, visibilityMap)
+        for p in path:
+            yield (p, incremental.update(p).window)
+        return
+    window = None
+    if algorithm == 'fov_rho':
+        # a context of its own: the working buffers stay sized for this radius, whatever else runs on the thread
+        context = fov_rho.RhoContext()
+        for p in path:
+            window = fov_rho.fov(p, losRadius, visibilityMap, out = window, context = context)
+            yield (p, window)
+        return
+    module = importlib.import_module(algorithm)
+    for p in path:
+        window = module.fov(p, losRadius, visibilityMap, out = window)
+        yield (p, window)
+
+def write_stream(filename, results, losRadius, typecode = 'f'):
+    """
+    Write a sequence of (viewerPos, fovWindow) results (e.g. fov_along_path) to a stream file, one frame at a time
+    typecode: of the stored values. 'f' (float32) halves the size, 'd' stores the values exactly
+    Returns the number of frames
+    """
+    count = 0
+    with open(filename, 'wb') as f:
+        f.write(_HEADER.pack(STREAM_MAGIC, losRadius, 0, typecode.encode('ascii')))
+        for (p, window) in results:
+            values = array(typecode, window.data)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            f.write(_FRAME_POS.pack(p.x, p.y))
+            f.write(values.tobytes())
+            count += 1
+        # the number of frames is only known at the end
+        f.seek(0)
+        f.write(_HEADER.pack(STREAM_MAGIC, losRadius, count, typecode.encode('ascii')))
+    return count
+
+class FovStream(object):
+    """
+        A stream file (see write_stream), memory-mapped. stream[i] is (viewerPos, fovWindow) of step i, where the
+        window is a zero-copy, read-only FovWindow over the file (with the stored typecode)
+        The windows are views of the file, so they must not outlive the stream: copy the ones to keep. close() (or
+        leaving a with block) doesn't fail on windows still referenced, the file just stays mapped until they're gone
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            (magic, self.losRadius, self.count, typecode) = _HEADER.unpack(f.read(_HEADER.size))
+            assert magic == STREAM_MAGIC, "not a FoV stream: " + filename
+            self.typecode = typecode.decode('ascii')
+            self.__mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.half = int(math.ceil(self.losRadius))
+        self.side = 2*self.half+1
+        self.frameBytes = _FRAME_POS.size + self.side*self.side*array(self.typecode).itemsize
+        self.__view = memoryview(self.__mmap)
+        self.closed = False
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, i):
+        if self.closed:
+            raise ValueError("FovStream is closed")
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("FovStream index out of range")
+        start = _HEADER.size + i*self.frameBytes
+        (x, y) = _FRAME_POS.unpack_from(self.__mmap, start)
+        data = self.__view[start + _FRAME_POS.size : start + self.frameBytes]
+        if sys.byteorder == 'big':
+            values = array(self.typecode, data)
+            values.byteswap()
+            data = values
+        else:
+            data = data.cast(self.typecode)
+        return (ivec2(x,y), FovWindow.wrap((x - self.half, y - self.half), self.losRadius, data))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.__view.release()
+        try:
+            self.__mmap.close()
+        except BufferError:
+            # windows still reference the map: it gets closed when the last of them is collected
+            pass
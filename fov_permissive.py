@@ -19,17 +19,38 @@
 from mathutil import *
 import copy
 
-def fov( viewerPos, losRadius, visibilityMap, onFovSetCallback = None, onFovStepCallback = None):
-    fovmap = Map2D( visibilityMap.width, visibilityMap.height, 0)
+def fov( viewerPos, losRadius, visibilityMap, onFovSetCallback = None, onFovStepCallback = None, out = None, fast = True, executor = None):
+    """
+        Returns a FovWindow with the visible tiles (as 1). out: optional FovWindow to reuse
+        fast: use the performance engine (same results and callback order). Otherwise run the original implementation
+        executor: optional concurrent.futures executor, to run the 4 quadrants of the performance engine concurrently
+                  (same results; the callbacks are called once per tile, but quadrant by quadrant in row order)
+    """
+    fovmap = FovWindow.reuse(out, viewerPos, losRadius)
+    fov_into( viewerPos, losRadius, visibilityMap, fovmap.data, fovmap.viewer_index(), fovmap.width, onFovSetCallback, fast, executor)
+    return fovmap
+    
+def fov_into( viewerPos, losRadius, visibilityMap, fdata, fbase, fstride, onFovSetCallback = None, fast = True, executor = None):
+    """
+        Same as fov, but write the visible tiles (as 1) to an existing zero-initialised buffer fdata,
+        where the viewer is at index fbase and rows are fstride apart (e.g. a full map, or a window around the viewer)
+    """
+    # the quadrant scans step whole tiles, so the extents are whole too: a fractional radius is truncated
+    losRadius = int(losRadius)
+    if fast:
+        __fieldOfViewFast( viewerPos.x, viewerPos.y, visibilityMap, losRadius, fdata, fbase, fstride, onFovSetCallback, executor)
+        return
+    vx = viewerPos.x
+    vy = viewerPos.y
+    vis = visibilityMap.data
+    w = visibilityMap.width
     def fn_visit(x,y):
-        p = ivec2(x,y)
-        fovmap.set(p, 1)
+        fdata[fbase + (x-vx) + (y-vy)*fstride] = 1
         if onFovSetCallback:
-            onFovSetCallback(p,1)
+            onFovSetCallback(ivec2(x,y),1)
     def fn_tile_blocked(x,y):
-        return visibilityMap.get(ivec2(x,y)) == 0
-    __fieldOfView( viewerPos.x, viewerPos.y, visibilityMap.width, visibilityMap.height, losRadius,fn_visit, fn_tile_blocked)
-    return fovmap
+        return vis[x + y*w] == 0
+    __fieldOfView( vx, vy, visibilityMap.width, visibilityMap.height, losRadius,fn_visit, fn_tile_blocked)
 
 def __fieldOfView(startX, startY, mapWidth, mapHeight, radius, \
   funcVisitTile, funcTileBlocked):
@@ -335,4 +356,177 @@ def __checkView(activeViews, viewIndex):
         del activeViews[viewIndex]
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+#-------------------------------------------------------------
+# Performance engine: the same algorithm, visiting the same tiles in the same order
+#   - views are __slots__ objects holding both lines as plain ints, and the slope tests are inlined
+#   - bumps are immutable (x, y, parent) tuples, so splitting a view copies 10 fields and shares the bump chains,
+#     instead of a deepcopy of the whole view
+#   - tiles are written straight into the zero-initialised result buffer, which doubles as the "visited" map:
+#     no set of tuples, no per-tile callbacks (unless one is given), no ivec2
+
+class __ViewFast(object):
+    __slots__ = ('sxi','syi','sxf','syf','txi','tyi','txf','tyf','shallowBump','steepBump')
+    def __init__(self, sxi, syi, sxf, syf, txi, tyi, txf, tyf, shallowBump = None, steepBump = None):
+        # shallow line (sxi,syi)->(sxf,syf), steep line (txi,tyi)->(txf,tyf)
+        self.sxi = sxi
+        self.syi = syi
+        self.sxf = sxf
+        self.syf = syf
+        self.txi = txi
+        self.tyi = tyi
+        self.txf = txf
+        self.tyf = tyf
+        self.shallowBump = shallowBump
+        self.steepBump = steepBump
+
+    def copy(self):
+        # structural copy: new lines, shared (immutable) bump chains
+        return self.__class__(self.sxi, self.syi, self.sxf, self.syf, self.txi, self.tyi, self.txf, self.tyf, self.shallowBump, self.steepBump)
+
+def __fieldOfViewFast(startX, startY, visibilityMap, radius, fdata, fbase, fstride, onFovSetCallback, executor = None):
+    w = visibilityMap.width
+    h = visibilityMap.height
+
+    # Will always see the centre.
+    fdata[fbase] = 1
+    if onFovSetCallback:
+        onFovSetCallback(ivec2(startX, startY), 1)
+
+    # the dimensions of the actual field of view, not going off the map or beyond the radius
+    minExtentX = startX if startX < radius else radius
+    maxExtentX = w - startX - 1 if w - startX - 1 < radius else radius
+    minExtentY = startY if startY < radius else radius
+    maxExtentY = h - startY - 1 if h - startY - 1 < radius else radius
+
+    # Northeast, Southeast, Southwest, Northwest quadrants
+    quadrants = ((1,1,maxExtentX,maxExtentY), (1,-1,maxExtentX,minExtentY), (-1,-1,minExtentX,minExtentY), (-1,1,minExtentX,maxExtentY))
+    if executor is None:
+        for (dx, dy, extentX, extentY) in quadrants:
+            __checkQuadrantFast(visibilityMap.data, w, startX, startY, dx, dy, extentX, extentY, fdata, fbase, fstride, onFovSetCallback)
+        return
+
+    # Concurrent quadrants: each one is visited into a (extentX+1) x (extentY+1) buffer of its own, then merged
+    tasks = [ executor.submit(__quadrantTask, visibilityMap, startX, startY, dx, dy, extentX, extentY) for (dx, dy, extentX, extentY) in quadrants]
+    for (dx, dy, extentX, extentY),task in zip(quadrants, tasks):
+        local = task.result()
+        lbase = extentX if dx < 0 else 0
+        for y in range(extentY+1):
+            for x in range(extentX+1):
+                if local[lbase + x*dx + y*(extentX+1)]:
+                    fidx = fbase + x*dx + y*dy*fstride
+                    if onFovSetCallback and fdata[fidx] == 0:
+                        onFovSetCallback(ivec2(startX + x*dx, startY + y*dy), 1)
+                    fdata[fidx] = 1
+
+def __quadrantTask(visibilityMap, startX, startY, dx, dy, extentX, extentY):
+    # Visit a quadrant into a new (extentX+1) x (extentY+1) buffer, with the viewer at its bottom row, on the left
+    # or right side (dx). The stride is signed with dy, so quadrant rows map to buffer rows 0..extentY. Returns the buffer
+    local = bytearray((extentX+1)*(extentY+1))
+    lbase = extentX if dx < 0 else 0
+    __checkQuadrantFast(visibilityMap.data, visibilityMap.width, startX, startY, dx, dy, extentX, extentY, local, lbase, dy*(extentX+1), None)
+    return local
+
+def __checkQuadrantFast(vis, w, startX, startY, dx, dy, extentX, extentY, fdata, fbase, fstride, onFovSetCallback):
+    ViewFast = __ViewFast
+    activeViews = [ ViewFast(0, 1, extentX, 0, 1, 0, 0, extentY)]
+    base = startX + startY*w
+    stepY = dy*w
+    fstepY = dy*fstride
+
+    # Visit the tiles diagonally and going outwards (see __checkQuadrant)
+    maxI = extentX + extentY
+    i = 1
+    while i != maxI + 1 and activeViews:
+        j = 0 if 0 > i - extentX else i - extentX
+        maxJ = i if i < extentY else extentY
+        while j != maxJ + 1 and activeViews:
+            x = i - j
+            y = j
+            j += 1
+            # tile corners: top left (x, y+1), bottom right (x+1, y)
+
+            # skip the views that are below the tile (the steep line is below or collinear with the bottom right corner)
+            viewIndex = 0
+            numViews = len(activeViews)
+            v = activeViews[0]
+            while (v.tyf - v.tyi)*(v.txf - x - 1) - (v.txf - v.txi)*(v.tyf - y) >= 0:
+                viewIndex += 1
+                if viewIndex == numViews:
+                    break
+                v = activeViews[viewIndex]
+            # above all the views, or below the shallow line of the current view (above or collinear with the top left corner)
+            if viewIndex == numViews or (v.syf - v.syi)*(v.sxf - x) - (v.sxf - v.sxi)*(v.syf - y - 1) <= 0:
+                continue
+
+            # visit the tile
+            fidx = fbase + x*dx + y*fstepY
+            if onFovSetCallback and fdata[fidx] == 0:
+                onFovSetCallback(ivec2(startX + x*dx, startY + y*dy), 1)
+            fdata[fidx] = 1
+
+            # a tile that doesn't block sight has no effect on the view
+            if vis[base + x*dx + y*stepY] != 0:
+                continue
+
+            # shallow line above the bottom right corner, steep line below the top left corner
+            shallowAbove = (v.syf - v.syi)*(v.sxf - x - 1) - (v.sxf - v.sxi)*(v.syf - y) < 0
+            steepBelow = (v.tyf - v.tyi)*(v.txf - x) - (v.txf - v.txi)*(v.tyf - y - 1) > 0
+            if shallowAbove and steepBelow:
+                # The view is completely blocked.
+                del activeViews[viewIndex]
+            elif shallowAbove:
+                # The shallow line needs to be raised.
+                __addShallowBumpFast(x, y + 1, v)
+                __checkViewFast(activeViews, viewIndex)
+            elif steepBelow:
+                # The steep line needs to be lowered.
+                __addSteepBumpFast(x + 1, y, v)
+                __checkViewFast(activeViews, viewIndex)
+            else:
+                # Split the current view into two views above and below the tile
+                shallowView = v.copy()
+                activeViews.insert(viewIndex, shallowView)
+                steepViewIndex = viewIndex + 1
+                __addSteepBumpFast(x + 1, y, shallowView)
+                if not __checkViewFast(activeViews, viewIndex):
+                    steepViewIndex -= 1
+                __addShallowBumpFast(x, y + 1, v)
+                __checkViewFast(activeViews, steepViewIndex)
+        i += 1
+
+def __addShallowBumpFast(x, y, v):
+    v.sxf = x
+    v.syf = y
+    v.shallowBump = (x, y, v.shallowBump)
+    bump = v.steepBump
+    while bump is not None:
+        # bump above the shallow line: raise the start of the line
+        if (v.syf - v.syi)*(v.sxf - bump[0]) - (v.sxf - v.sxi)*(v.syf - bump[1]) < 0:
+            v.sxi = bump[0]
+            v.syi = bump[1]
+        bump = bump[2]
+
+def __addSteepBumpFast(x, y, v):
+    v.txf = x
+    v.tyf = y
+    v.steepBump = (x, y, v.steepBump)
+    bump = v.shallowBump
+    while bump is not None:
+        # bump below the steep line: lower the start of the line
+        if (v.tyf - v.tyi)*(v.txf - bump[0]) - (v.txf - v.txi)*(v.tyf - bump[1]) > 0:
+            v.txi = bump[0]
+            v.tyi = bump[1]
+        bump = bump[2]
+
+def __checkViewFast(activeViews, viewIndex):
+    # Same as __checkView: remove the view if its lines are collinear and pass through either extremity
+    v = activeViews[viewIndex]
+    sdx = v.sxf - v.sxi
+    sdy = v.syf - v.syi
+    if sdy*(v.sxf - v.txi) - sdx*(v.syf - v.tyi) == 0 and sdy*(v.sxf - v.txf) - sdx*(v.syf - v.tyf) == 0 \
+      and ( sdy*v.sxf - sdx*(v.syf - 1) == 0 or sdy*(v.sxf - 1) - sdx*v.syf == 0):
+        del activeViews[viewIndex]
+        return False
+    return True
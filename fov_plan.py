@@ -0,0 +1,227 @@
+import math
+import threading
+from array import array
+from collections import OrderedDict
+from mathutil import *
+
+"""
+    Precompiled plan for the spiral FoV engine
+
+    Everything the spiral engine computes per point depends only on the offset from the viewer, not on the map:
+    the sign of the offset, which previous neighbour is diagonal and which is straight, the interpolation weight t
+    and the distance-based decay. A FovPlan computes all of these ONCE per (radius, decay, falloff) and stores them in
+    flat arrays, in spiral order, so that the per-call work is a single pass over those arrays. Only the decay tables
+    depend on the decay, so the plans of a radius share everything else.
+"""
+
+class FovPlan(object):
+    """
+        Flat per-point arrays, in spiral order. Point 0 is the viewer itself; the rest are sortedPoints.range(1,losRadius)
+            ox, oy:     offset from the viewer
+            nb0, nb1:   plan indices of the previous neighbours: nb0 is the straight one, nb1 the diagonal one.
+                        Points on the diagonals/straight lines have a single neighbour, so nb0 == nb1 (and t == 0)
+            t, u:       interpolation weight between nb0 and nb1, and its complement (1-t)
+            dist:       distance to the viewer
+            decay:      decay at the point (see mathutil.decay_table)
+            prevDecay:  interpolated decay of the neighbours
+        bands: contiguous (start,end) ranges of the spiral where no point depends on another point of the same range
+               (each point only depends on strictly closer neighbours), so a whole band can be evaluated at once
+    """
+    # the arrays that don't depend on the decay, shared by the plans of the same radius
+    GEOMETRY = ('lookup', 'size', 'ox', 'oy', 'nb0', 'nb1', 't', 'u', 'dist', 'bands', 'children')
+
+    def __init__(self, losRadius, decayPercent, falloff = 'linear', geometry = None):
+        """
+            falloff:  curve of the decay over the distance (see mathutil.FALLOFFS)
+            geometry: optional plan of the same radius, to share the decay-independent arrays with (see GEOMETRY)
+        """
+        self.losRadius = losRadius
+        self.decayPercent = decayPercent
+        self.falloff = falloff
+        if geometry is None:
+            self.__build_geometry()
+        else:
+            assert geometry.losRadius == losRadius
+            for name in FovPlan.GEOMETRY:
+                setattr(self, name, getattr(geometry, name))
+
+        # the decay of each point is a lookup table, and so is the interpolated decay of its neighbours
+        self.decay = decay_table(self.dist, losRadius, decayPercent, falloff)
+        self.prevDecay = array('d', [0.0]) * self.size
+        for i in range(1, self.size):
+            a = self.nb0[i]
+            b = self.nb1[i]
+            self.prevDecay[i] = self.decay[a] if a == b else lerp(self.decay[a], self.decay[b], self.t[i])
+
+        # per-point loop tuples (excluding the viewer), so the engine loop is a plain tuple unpacking
+        self.steps = list(zip( range(1,self.size), self.nb0[1:], self.nb1[1:], self.u[1:], self.t[1:],
+                               self.prevDecay[1:], self.decay[1:], self.dist[1:]))
+        self.__deltas = {}
+        self.__numpy = None
+
+    def __build_geometry(self):
+        points = [ivec2(0,0)]
+        points.extend( SortedPoints(self.losRadius).range(1,self.losRadius))
+        # plan index of each offset
+        self.lookup = lookup = { (o.x,o.y) : i for i,o in enumerate(points)}
+
+        self.size = len(points)
+        self.ox = array('i', [o.x for o in points])
+        self.oy = array('i', [o.y for o in points])
+        self.nb0 = array('i', [0]) * self.size
+        self.nb1 = array('i', [0]) * self.size
+        self.t = array('d', [0.0]) * self.size
+        self.u = array('d', [1.0]) * self.size
+        self.dist = array('d', [o.length() for o in points])
+
+        for i in range(1, self.size):
+            ox = self.ox[i]
+            oy = self.oy[i]
+            ox_abs = abs(ox)
+            oy_abs = abs(oy)
+            sx = sign(ox)
+            sy = sign(oy)
+            # the closest diagonal (move back 1 unit in both X and Y)
+            diag = lookup[(ox-sx, oy-sy)]
+            # diagonal or axis-aligned: previous contribution comes from a SINGLE tile
+            if (ox_abs == oy_abs) or (ox_abs*oy_abs == 0):
+                self.nb0[i] = self.nb1[i] = diag
+            # NOT diagonal or axis-aligned: previous contribution comes from TWO tiles
+            else:
+                # the closest non-diagonal. Move back 1 unit in the axis of greater magnitude
+                straight = lookup[(ox-sx, oy)] if ox_abs > oy_abs else lookup[(ox, oy-sy)]
+                # if we're further along X, we need more contribution from the diagonal
+                axis = 1 if ox_abs > oy_abs else 0
+                t = normalized2(ox_abs, oy_abs)[axis]
+                self.nb0[i] = straight
+                self.nb1[i] = diag
+                self.t[i] = t
+                self.u[i] = 1-t
+
+        # split the spiral into bands: start a new band whenever a point depends on a point of the current band
+        self.bands = [(0,1)]
+        start = 1
+        for i in range(1, self.size):
+            if self.nb0[i] >= start or self.nb1[i] >= start:
+                self.bands.append((start,i))
+                start = i
+        if start < self.size:
+            self.bands.append((start,self.size))
+
+        # the points that depend on each point (inverse of nb0/nb1)
+        self.children = [[] for i in range(self.size)]
+        for i in range(1, self.size):
+            self.children[self.nb0[i]].append(i)
+            if self.nb1[i] != self.nb0[i]:
+                self.children[self.nb1[i]].append(i)
+
+    def deltas(self, width):
+        # linear index deltas (ox + oy*width) of all points, for a map/buffer of the given width. Cached per width
+        d = self.__deltas.get(width)
+        if d is None:
+            d = [x + y*width for x,y in zip(self.ox, self.oy)]
+            self.__deltas[width] = d
+        return d
+
+    def as_numpy(self):
+        # numpy copies of the per-point arrays (as a dict), for the vectorized engines. Requires numpy
+        if self.__numpy is None:
+            import numpy
+            self.__numpy = { name : numpy.array(getattr(self,name)) for name in ('ox','oy','nb0','nb1','t','u','dist','decay','prevDecay')}
+        return self.__numpy
+
+    def run(self, viewerPos, visibilityMap, fovmap, onFovSetCallback = None, onFovStepCallback = None):
+        """
+            Run the spiral engine for a viewer, writing the visibility values to fovmap (a zero-initialised FovWindow around
+            the viewer, or a Map2D of the same size as visibilityMap)
+            Callbacks are as in fov_spiral_buggy.fov
+        """
+        self.run_into(viewerPos, visibilityMap, fovmap.data, fovmap.linear_index(viewerPos), fovmap.width, onFovSetCallback, onFovStepCallback)
+        return fovmap
+
+    def run_into(self, viewerPos, visibilityMap, fdata, fbase, fstride, onFovSetCallback = None, onFovStepCallback = None):
+        """
+            Same as run, but write the visibility values to an existing zero-initialised buffer fdata,
+            where the viewer is at index fbase and rows are fstride apart (e.g. a full map, or a window around the viewer)
+            Returns the number of plan points processed before the early exit (self.size if there was none)
+        """
+        vx = viewerPos.x
+        vy = viewerPos.y
+        w = visibilityMap.width
+        h = visibilityMap.height
+        vis = visibilityMap.data
+        base = vx + vy*w
+        r = int(math.ceil(self.losRadius))
+        # if the whole LOS square is in the map, we can skip the per-point bounds checks
+        clipped = vx < r or vy < r or vx + r >= w or vy + r >= h
+
+        # visibility propagated FROM each point: "visibility at tile" * "visibility propagation so far"
+        prop = [0.0] * self.size
+
+        # initialise: the viewer position is always visible
+        fdata[fbase] = 1
+        prop[0] = vis[base]
+        if onFovSetCallback:
+            onFovSetCallback(viewerPos, 1)
+
+        ox = self.ox
+        oy = self.oy
+        maxRadiusUsed = 0 # Keep track of the max radius we've processed so far
+        deltas = self.deltas(w)
+        fdeltas = self.deltas(fstride)
+        for i, a, b, u, t, prevDecay, curDecay, omag in self.steps:
+            # Only process points in map
+            if clipped:
+                px = vx + ox[i]
+                py = vy + oy[i]
+                if px < 0 or px >= w or py < 0 or py >= h:
+                    continue
+
+            # if we've made a full round in the sorted points spiral without adding a tile, early exit
+            if (omag - maxRadiusUsed) >= 2.0:
+                return i
+
+            # interpolate the neighbours' visibility (single neighbours have u=1, t=0) and apply the decay
+            amt = u*prop[a] + t*prop[b]
+            amt = max(amt + prevDecay - curDecay, 0.0)
+
+            fdata[fbase + fdeltas[i]] = amt
+            prop[i] = vis[base + deltas[i]] * amt
+
+            if onFovStepCallback or onFovSetCallback:
+                p = ivec2(vx + ox[i], vy + oy[i])
+                if onFovStepCallback:
+                    nbs = [ivec2(vx + ox[b], vy + oy[b])]
+                    if a != b:
+                        nbs.append(ivec2(vx + ox[a], vy + oy[a]))
+                    onFovStepCallback(p, nbs, amt)
+                if onFovSetCallback:
+                    onFovSetCallback(p, amt)
+            if amt > 0:
+                maxRadiusUsed = omag
+        return self.size
+
+# compiled plans, per (radius, decay, falloff), and a plan of each radius (to share its geometry). Both are LRU
+# caches: radii and decays can vary freely (e.g. per light), so only the last MAX_PLANS of each are kept
+MAX_PLANS = 64
+__plans = OrderedDict()
+__geometries = OrderedDict()
+__plans_lock = threading.Lock()
+def get_plan(losRadius, decayPercent, falloff = 'linear'):
+    # get (or compile once) the plan for a radius and decay. Changing the decay only rebuilds the decay tables
+    key = (losRadius, decayPercent, falloff)
+    with __plans_lock:
+        plan = __plans.get(key)
+        if plan is not None:
+            __plans.move_to_end(key)
+            return plan
+        geometry = __geometries.get(losRadius)
+    plan = FovPlan(losRadius, decayPercent, falloff, geometry)
+    with __plans_lock:
+        __plans[key] = plan
+        __geometries[losRadius] = plan if geometry is None else geometry
+        __geometries.move_to_end(losRadius)
+        for cache in (__plans, __geometries):
+            while len(cache) > MAX_PLANS:
+                cache.popitem(last=False)
+    return plan
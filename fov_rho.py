@@ -1,12 +1,20 @@
 import math
 from timeit import default_timer as timer
 from enum import IntEnum
+import threading
+from collections import OrderedDict
+from array import array
 from mathutil import *
 
 
 MAX_LOS = 50 # arbitrary -- there's no precalculation based on this
 # Smaller value (always in [0,1]) leads to less decay
 DECAY_PER_TILE_PERCENT = 0.0 # e.g. Visibility reduces to 90% from a tile to the next
+# Shape of the decay over the distance: 'linear', 'smoothstep' or 'smootherstep' (see mathutil.FALLOFFS)
+DECAY_FALLOFF = 'linear'
+
+# the list of sorted points (only used by fov_symmetry), grown on demand
+sortedPoints = SortedPoints()
 
 """
     FoV algorithm based on the implicit rhombus mesh of each octant
@@ -22,177 +30,497 @@ DECAY_PER_TILE_PERCENT = 0.0 # e.g. Visibility reduces to 90% from a tile to the
     2 versions in cache?
 """
 
-# cache for storing BOTH incoming visibility values for a point
-# when we PROPAGATE visibility, we choose ONE of our sources. Therefore, we avoid any large parallelogram visibility integrals
-# we dynamically resize it, so empty is fine here
-cache = []
-def fov( viewerPos, losRadius, visibilityMap, onFovSetCallback = None, debugPos = None, fnContributorsToDebugPos = None):
+# The octants. Represent them as a "forward" direction (along the straight line) and an "up" direction, perpendicular to the forward, towards the diagonal
+axis_sets = [
+    (ivec2(1,0),ivec2(0,1)),
+    (ivec2(1,0),ivec2(0,-1)),
+    (ivec2(0,1),ivec2(1,0)),
+    (ivec2(0,1),ivec2(-1,0)),
+    (ivec2(-1,0),ivec2(0,1)),
+    (ivec2(-1,0),ivec2(0,-1)),
+    (ivec2(0,-1),ivec2(-1,0)),
+    (ivec2(0,-1),ivec2(1,0)),
+]
+
+def calc_idx( for_diag, col_new, row_new):
+    # which of the two incoming values (0: diagonal, 1: straight) of a source cell propagates to the cell (col_new,row_new)
+    col_new -= row_new # convert to square
+    n = normalized2(col_new, row_new)
+    if for_diag: # we are lower.
+        n0 = normalized2(col_new-2, row_new-2)
+        n1 = normalized2(col_new-2, row_new-1)
+        return 0 if dot(n0,n) > dot(n1,n) else 1
+    else:
+        n0 = normalized2(col_new-2, row_new-1)
+        n1 = normalized2(col_new-2, row_new-0)
+        return 0 if dot(n0,n) > dot(n1,n) else 1
+
+class RhoTables(object):
+    """
+        The per-cell values of the engine that only depend on (col,row), for 0 <= row <= col < rmax, shared by all
+        octants and all calls. Flat, in column order: cell (col,row) is at col*(col+1)//2 + row
+            contribDiag, contribStraight:   contribution factors of the visibility that the cell propagates to
+                                            (col+1,row+1) (diagonal) and (col+1,row) (straight)
+            selDiag, selStraight:           calc_idx of those two propagations (which incoming value of the cell propagates)
+            dist:                           distance of the cell to the viewer
+        previous: smaller tables to grow from (their columns are copied, not recomputed)
+        The decay of each cell is a table too, built on demand per (radius, decay, falloff) by decay(), covering the
+        cells of that radius only. The last MAX_DECAY_TABLES are kept. No decay is a single table of zeros
+    """
+    MAX_DECAY_TABLES = 16
+    
+    def __init__(self, rmax, previous = None):
+        self.rmax = rmax
+        self.decays = OrderedDict() # (radius, decay, falloff) -> table, least recently used first
+        self.noDecay = None
+        self.lock = threading.Lock()
+        start = 0
+        if previous is None:
+            self.contribDiag = array('d')
+            self.contribStraight = array('d')
+            self.selDiag = array('b')
+            self.selStraight = array('b')
+            self.dist = array('d')
+        else:
+            start = previous.rmax
+            self.contribDiag = array('d', previous.contribDiag)
+            self.contribStraight = array('d', previous.contribStraight)
+            self.selDiag = array('b', previous.selDiag)
+            self.selStraight = array('b', previous.selStraight)
+            self.dist = array('d', previous.dist)
+        for col in range(start, rmax):
+            # we'll be using that to multiply the pnbs
+            mult = col / (col+1.0)
+            for row in range(0, col+1):
+                pnbf = (row+1)*mult
+                self.contribDiag.append( 1- (pnbf - row)) # we're coming from lower, so if pnbf at the floor, we want max contribution
+                pnby = row*mult
+                self.contribStraight.append( 1- (row-pnby)) # we're coming from upper, so if pnby at the top, we want max contribution
+                self.selDiag.append( calc_idx(True, col+1, row+1))
+                self.selStraight.append( calc_idx(False, col+1, row))
+                self.dist.append( math.sqrt(col*col + row*row))
+                
+    def decay(self, losRadius, decayPercent, falloff = 'linear'):
+        # the decay of each cell (indexed like dist) within a radius, for a decay and falloff (see mathutil.decay_table)
+        if decayPercent == 0:
+            if self.noDecay is None:
+                self.noDecay = array('d', [0.0]) * len(self.dist)
+            return self.noDecay
+        key = (losRadius, decayPercent, falloff)
+        with self.lock:
+            table = self.decays.get(key)
+            if table is not None:
+                self.decays.move_to_end(key)
+                return table
+        rmax = math.ceil(losRadius)+1
+        table = decay_table(self.dist[:rmax*(rmax+1)//2], losRadius, decayPercent, falloff)
+        with self.lock:
+            self.decays[key] = table
+            while len(self.decays) > self.MAX_DECAY_TABLES:
+                self.decays.popitem(last=False)
+        return table
+                
+# the shared tables. Replaced (never modified) when they grow, so concurrent calls can keep using the old ones
+__tables = None
+def rho_tables(rmax):
+    # tables covering at least rmax columns. They grow (to at least double size, to amortize growing) on demand
+    global __tables
+    tables = __tables
+    if tables is None or tables.rmax < rmax:
+        tables = __tables = RhoTables( max(rmax, 2*tables.rmax) if tables else rmax, tables)
+    return tables
+
+class RhoContext(object):
+    """
+        Working state of the rhombus engine, so that concurrent calls (e.g. from worker threads) don't share anything
+        In an octant, cell (col,row) only propagates to (col+1,row+1) and (col+1,row), so a column only feeds the next one.
+        The state is two flat float buffers, for the current and the next column, storing BOTH incoming visibility
+        values of each row: [2*row] is the diagonal input, [2*row+1] the straight input.
+        When we PROPAGATE visibility, we choose ONE of our sources. Therefore, we avoid any large parallelogram visibility integrals
+        The buffers grow when a larger radius is requested
+    """
+    def __init__(self, rmax = 0):
+        self.rmax = 0
+        self.cur = array('d')
+        self.next = array('d')
+        self.reserve(rmax)
+        
+    def reserve(self, rmax):
+        if rmax > self.rmax:
+            self.rmax = rmax
+            self.cur = array('d', [0.0]) * (2*rmax+2)
+            self.next = array('d', [0.0]) * (2*rmax+2)
+        
+# the free contexts of each thread. A call takes one for the time of its sweep and gives it back, so a nested call
+# on the same thread (e.g. from onFovSetCallback) gets another context instead of overwriting the caller's buffers
+__thread_contexts = threading.local()
+def acquire_context():
+    # a RhoContext of the calling thread that no other call is using. Give it back with release_context
+    free = getattr(__thread_contexts, 'free', None)
+    if free is None:
+        free = __thread_contexts.free = []
+    return free.pop() if free else RhoContext()
+
+def release_context(context):
+    # give back a context from acquire_context, for reuse by the next calls of the calling thread
+    __thread_contexts.free.append(context)
+    
+def fov( viewerPos, losRadius, visibilityMap, onFovSetCallback = None, debugPos = None, fnContributorsToDebugPos = None, out = None, context = None, executor = None):
     """
     Calculate the field-of-vision map (0: can't see, 1: see maximum, and anything in between)
     onFovSetCallback: callback to mark all the cells we've visited (parameters: position and visibility value)
+    out: optional FovWindow to reuse
+    context: optional RhoContext for the working state, not used by any other call in progress (default: a free one of the thread)
+    executor: optional concurrent.futures executor, to sweep the 8 octants concurrently (for very large radii).
+              Thread pools share the map; process pools get a pickled copy of it for every octant
+    Returns a FovWindow (the window around the viewer, with absolute-position accessors)
     """
-    global cache
-    
-    # Initialise map. 
-    fovmap = Map2D( visibilityMap.width, visibilityMap.height, 0)
+    # Initialise the window around the viewer. Nothing outside it can be visible
+    fovmap = FovWindow.reuse(out, viewerPos, losRadius)
+    fov_into( viewerPos, losRadius, visibilityMap, fovmap.data, fovmap.viewer_index(), fovmap.width, onFovSetCallback, debugPos, fnContributorsToDebugPos, context, executor)
+    return fovmap
     
+def fov_into( viewerPos, losRadius, visibilityMap, fdata, fbase, fstride, onFovSetCallback = None, debugPos = None, fnContributorsToDebugPos = None, context = None, executor = None):
+    """
+    Same as fov, but write the field-of-vision values to an existing zero-initialised buffer fdata,
+    where the viewer is at index fbase and rows are fstride apart (e.g. a full map, or a window around the viewer)
+    """
     # The algorithm supports visibility reduction from one tile to the next, based on losRadius (so at losRadius we've lost all visibility)
-    # We can adjust this decay using DECAY_PER_TILE_PERCENT
-    decayPerTile = DECAY_PER_TILE_PERCENT/float(losRadius)
-    decayPerTile = 0
-    
-    def calc_decay( q ):
-        # Helper to calculate decay percentage, based on distance of a point q to the viewer
-        return (q - viewerPos).length() * decayPerTile; # decay until last tile. proportional to distance
+    # We can adjust this decay using DECAY_PER_TILE_PERCENT, and its curve using DECAY_FALLOFF
+    # The decay only depends on the cell, so it's read from a table (indexed like RhoTables.dist)
+    decayPercent = DECAY_PER_TILE_PERCENT
+    decayPercent = 0
+  
+    # The hot loops below run on plain ints: absolute positions are never built as ivec2, and map cells are
+    # addressed with linear indices plus precomputed index deltas (dx + dy*width)
+    vx = viewerPos.x
+    vy = viewerPos.y
+    w = visibilityMap.width
+    h = visibilityMap.height
+    vis = visibilityMap.data
+    vidx = vx + vy*w
   
     # initialise: the viewer position is always visible
-    fovmap.set(viewerPos, 1)
+    fdata[fbase] = 1
     if onFovSetCallback:
         onFovSetCallback(viewerPos, 1)
         
     losRadiusSquared = losRadius*losRadius
     rmax = math.ceil(losRadius)+1
+    decay = rho_tables(rmax).decay(losRadius, decayPercent, DECAY_FALLOFF)
         
     # do the diagonals/straight lines
     for y in range(-1,2):
         for x in range(-1,2):
             if x != 0 or y != 0:
-                for i in range(1,rmax):
-                    o = ivec2(x*i,y*i)
-                    p = viewerPos + o
-                    # handle out-of-bounds and further from los radius
-                    if (not fovmap.in_bounds(p)) or (o.squaredLength() > losRadiusSquared):
-                        continue
-                    pnb = p - ivec2(x,y)
+                step = x + y*w
+                fstep = x + y*fstride
+                # the cells of the line that are in the map and within the los radius
+                (lo, hi) = __clip_to_map( vx, vy, x, y, 1, min(rmax-1, __max_within(losRadiusSquared, x*x + y*y)), w, h)
+                for i in range(lo,hi+1):
+                    idx = vidx + step*i
+                    fidx = fbase + fstep*i
                     # propagate visibility multiplicatively based on last cell's values
-                    amt = visibilityMap.get(pnb) * fovmap.get(pnb)
-                    fovmap.set(p,amt) # don't add decay -- we're going to add that later
+                    fdata[fidx] = vis[idx-step] * fdata[fidx-fstep] # don't add decay -- we're going to add that later
       
-    # resize the cache to fit everything. 
-    # Each cache element contains 3 entries: diagonal input, straight input, source cells contributing to this
-    cache_len = rmax*rmax
-    if len(cache) < cache_len:
-        remain = cache_len - len(cache)
-        cache += [[0,0,[]] for i in range(remain)]
-    
-    
-    # do the inner octant parts. Represent them as a "forward" direction (along the straight line) and an "up" direction, perpendicular to the forward, towards the diagonal
-    axis_sets = [
-        (ivec2(1,0),ivec2(0,1)),
-        (ivec2(1,0),ivec2(0,-1)),
-        (ivec2(0,1),ivec2(1,0)),
-        (ivec2(0,1),ivec2(-1,0)),
-        (ivec2(-1,0),ivec2(0,1)),
-        (ivec2(-1,0),ivec2(0,-1)),
-        (ivec2(0,-1),ivec2(-1,0)),
-        (ivec2(0,-1),ivec2(1,0)),
-    ]
-    
-    def calc_idx( for_diag, col_new, row_new):
-        col_new -= row_new # convert to square
-        n = ivec2(col_new, row_new).normalized()
-        if for_diag: # we are lower.
-            n0 = ivec2(col_new-2, row_new-2).normalized()
-            n1 = ivec2(col_new-2, row_new-1).normalized()
-            return 0 if dot(n0,n) > dot(n1,n) else 1
-        else:
-            n0 = ivec2(col_new-2, row_new-1).normalized()
-            n1 = ivec2(col_new-2, row_new-0).normalized()
-            return 0 if dot(n0,n) > dot(n1,n) else 1
-    
-    for (fwd,up) in axis_sets:
-        diag = up+fwd
-        for c in cache:
-            c[0] = c[1] = 0
-            c[2] = []
-        for row in range(0,rmax):
-            for col in range(row,rmax):
-                # skip the first point, already calculated and contributes to no inner point directly
-                if col == 0 and row == 0: 
-                    continue
-                    
-                is_inner_octant_pt = row != col and col != 0 and row != 0
-                    
-                # calculate the offset
-                o = fwd.muls(col) + up.muls(row)
-                
-                # calculate the absolute position
-                p = viewerPos + o
-                # if not in bounds, or further than max los, skip
-                if (not fovmap.in_bounds(p)) or (o.squaredLength() > losRadiusSquared):
-                    continue
-                    
-                do_debug = debugPos and debugPos == p
-                
-                # get current visibility FOR the cell, and the visibility AT the cell
-                amt_cache = cache[col+row*rmax] if is_inner_octant_pt else fovmap.get(p)
-                #amt = max(amt_cache[0],amt_cache[1]) if is_inner_octant_pt else amt_cache
-                amt = amt_cache[0] + amt_cache[1] if is_inner_octant_pt else amt_cache
-                vis = visibilityMap.get(p)
-                
-                # we'll be using that to multiply the pnbs
-                mult = col / (col+1.0)
-                
-                # cache element order is processing order: diagonal == 0, straight==1
-                
-                # see if we need to update our top-right neighbour
-                pnb = p + diag
-                if col != row and fovmap.in_bounds(pnb) and (pnb-viewerPos).squaredLength() <= losRadiusSquared:
-                    # calculate this tile's contribution 
-                    pnbf = (row+1)*mult
-                    contribution = 1- (pnbf - row) # we're coming from lower, so if pnbf at the floor, we want max contribution
-                    c = cache[(col+1)+(row+1)*rmax]
-                    idx = calc_idx(True, col+1, row+1)
-                    amt_cur = amt_cache[idx] if is_inner_octant_pt else amt_cache 
-                    amt_cur *= contribution*vis
-                    #c[0] = max(c[0], amt_cur) # write to the DIAG element
-                    c[0] += amt_cur
-                    
-                    if do_debug and amt_cur > 0:
-                        c[2].append( (p- ivec2(1,0) if idx == 1 else p- ivec2(1,1),amt_cur))
-                        
-                # see if we need to update our right neighbour
-                pnb = p + fwd
-                if row > 0 and fovmap.in_bounds(pnb) and (pnb-viewerPos).squaredLength() <= losRadiusSquared:
-                    pnby = row*mult
-                    contribution = 1- (row-pnby) # we're coming from upper, so if pnby at the top, we want max contribution
-                    c = cache[(col+1)+row*rmax]
-                    idx = calc_idx(False, col+1, row)
-                    amt_cur = amt_cache[idx] if is_inner_octant_pt else amt_cache 
-                    amt_cur *= contribution*vis
-                    #c[1] = max(c[1], amt_cur) # write to the HORZ element
-                    c[1] += amt_cur
-                    
-                    if do_debug and amt_cur > 0:
-                        c[2].append( (p- ivec2(1,0) if idx == 1 else p- ivec2(1,1),amt_cur))
-                        
-                # NOW apply the decay, after we've propagated, but only if it's not straight/diag
-                # Because we're never going to use these values again, while the straight/diagonals could be used in other octants
-                if is_inner_octant_pt:
-                    amt = max(amt-calc_decay(p),0)
-                    fovmap.set( p, amt) 
-                    if onFovSetCallback:
-                        onFovSetCallback(p, amt)
-                        
-                if do_debug:
-                    fnContributorsToDebugPos(c[2])
+    # do the inner octant parts (see axis_sets). Once the lines are done, the octants are independent
+    if executor is not None and debugPos is None:
+        # each octant task gets the values of its two lines, and sweeps into a window of its own
+        tasks = []
+        for (fwd,up) in axis_sets:
+            lineStraight = [ fdata[fbase + (fwd.x + fwd.y*fstride)*i] if __in_los(vx, vy, fwd.x*i, fwd.y*i, w, h, losRadiusSquared) else 0.0 for i in range(rmax)]
+            lineDiag = [ fdata[fbase + (fwd.x + up.x + (fwd.y + up.y)*fstride)*i] if __in_los(vx, vy, (fwd.x+up.x)*i, (fwd.y+up.y)*i, w, h, losRadiusSquared) else 0.0 for i in range(rmax)]
+            tasks.append( executor.submit( __octant_task, fwd, up, viewerPos, losRadius, visibilityMap, lineStraight, lineDiag, decay))
+        # merge the inner cells of each octant
+        half = rmax-1
+        side = 2*half+1
+        center = half + half*side
+        for (fwd,up),task in zip(axis_sets, tasks):
+            local = task.result()
+            for col in range(2,rmax):
+                for row in range(1,col):
+                    ox = fwd.x*col + up.x*row
+                    oy = fwd.y*col + up.y*row
+                    if __in_los(vx, vy, ox, oy, w, h, losRadiusSquared):
+                        amt = local[center + ox + oy*side]
+                        fdata[fbase + ox + oy*fstride] = amt
+                        if onFovSetCallback:
+                            onFovSetCallback(ivec2(vx+ox,vy+oy), amt)
+    else:
+        owned = context is None
+        if owned:
+            context = acquire_context()
+        try:
+            for (fwd,up) in axis_sets:
+                __sweep_octant( fwd, up, vx, vy, losRadius, visibilityMap, fdata, fbase, fstride, context, decay, onFovSetCallback, debugPos, fnContributorsToDebugPos)
+        finally:
+            if owned:
+                release_context(context)
    
     # ADD DECAY to the diagonals/straight lines
     for y in range(-1,2):
         for x in range(-1,2):
             if x != 0 or y != 0:
-                for i in range(1,rmax):
-                    o = ivec2(x*i,y*i)
-                    p = viewerPos + o
-                    if (not fovmap.in_bounds(p)) or (o.squaredLength() > losRadiusSquared):
-                        continue
-                    amt = max(fovmap.get(p)-calc_decay(p),0)
-                    fovmap.set(p,amt)
+                fstep = x + y*fstride
+                # the line cells are (i,0) of their octant for straight lines, (i,i) for diagonals
+                diagonal = 1 if x != 0 and y != 0 else 0
+                (lo, hi) = __clip_to_map( vx, vy, x, y, 1, min(rmax-1, __max_within(losRadiusSquared, x*x + y*y)), w, h)
+                for i in range(lo,hi+1):
+                    fidx = fbase + fstep*i
+                    amt = max(fdata[fidx]-decay[i*(i+1)//2 + i*diagonal],0)
+                    fdata[fidx] = amt
                     if onFovSetCallback:
-                        onFovSetCallback(p, amt)
+                        onFovSetCallback(ivec2(vx + x*i,vy + y*i), amt)
     
-    return fovmap
+def __max_within( limit, scale = 1):
+    # the largest integer k with k*k*scale <= limit (-1 if limit < 0)
+    if limit < 0:
+        return -1
+    k = int(math.sqrt(limit/scale))
+    while k*k*scale > limit:
+        k -= 1
+    while (k+1)*(k+1)*scale <= limit:
+        k += 1
+    return k
+    
+def __clip_to_map( px0, py0, ux, uy, lo, hi, w, h):
+    # the sub-interval of [lo,hi] of the k where (px0 + ux*k, py0 + uy*k) is in the map (empty if lo > hi). ux,uy in {-1,0,1}
+    if ux > 0:
+        if lo < -px0:
+            lo = -px0
+        if hi > w-1-px0:
+            hi = w-1-px0
+    elif ux < 0:
+        if lo < px0-w+1:
+            lo = px0-w+1
+        if hi > px0:
+            hi = px0
+    elif px0 < 0 or px0 >= w:
+        return (0,-1)
+    if uy > 0:
+        if lo < -py0:
+            lo = -py0
+        if hi > h-1-py0:
+            hi = h-1-py0
+    elif uy < 0:
+        if lo < py0-h+1:
+            lo = py0-h+1
+        if hi > py0:
+            hi = py0
+    elif py0 < 0 or py0 >= h:
+        return (0,-1)
+    return (lo, hi)
+    
+def __column_rows( vx, vy, fx, fy, ux, uy, col, w, h, losRadiusSquared):
+    # the interval [lo,hi] of the rows of an octant column that are in the map and within the los radius
+    hi = __max_within(losRadiusSquared - col*col)
+    return __clip_to_map( vx + fx*col, vy + fy*col, ux, uy, 0, col if col < hi else hi, w, h)
+    
+def __in_los( vx, vy, ox, oy, w, h, losRadiusSquared):
+    # if the offset from the viewer is in the map and within the los radius
+    px = vx + ox
+    py = vy + oy
+    return px >= 0 and px < w and py >= 0 and py < h and (ox*ox + oy*oy) <= losRadiusSquared
+    
+def __octant_task( fwd, up, viewerPos, losRadius, visibilityMap, lineStraight, lineDiag, decay):
+    # Sweep one octant into a new window around the viewer, given the (undecayed) values of its two lines. Returns the window data
+    rmax = math.ceil(losRadius)+1
+    half = rmax-1
+    side = 2*half+1
+    center = half + half*side
+    local = array('d', [0.0]) * (side*side)
+    for i in range(rmax):
+        local[center + (fwd.x + fwd.y*side)*i] = lineStraight[i]
+        local[center + (fwd.x + up.x + (fwd.y + up.y)*side)*i] = lineDiag[i]
+    context = acquire_context()
+    try:
+        __sweep_octant( fwd, up, viewerPos.x, viewerPos.y, losRadius, visibilityMap, local, center, side, context, decay)
+    finally:
+        release_context(context)
+    return local
+    
+def __row_runs( a, b, dlo, dhi, slo, shi):
+    # split the rows [a,b] into runs [start,end) whose rows all update their top-right neighbour (dlo <= row <= dhi)
+    # or all don't, and all update their right neighbour (slo <= row <= shi) or all don't
+    cuts = sorted(set( c for c in (a, dlo, dhi+1, slo, shi+1, b+1) if a <= c <= b+1))
+    return [ (start, end, dlo <= start <= dhi, slo <= start <= shi) for (start, end) in zip(cuts, cuts[1:])]
+    
+def __sweep_rows_instrumented( start, end, diag, straight, col, tcol, idx0, fidx0, ustep, fustep, px0, py0, ux, uy,
+                               vis, fdata, cur, nxt, tables, decay, dbgIdx, onFovSetCallback, debugPos, fnContributorsToDebugPos):
+    # a run of inner cells of a column (see __sweep_octant), with the callbacks and the debug contributors
+    contribDiag = tables.contribDiag
+    contribStraight = tables.contribStraight
+    selDiag = tables.selDiag
+    selStraight = tables.selStraight
+    for row in range(start, end):
+        t = tcol+row
+        r2 = 2*row
+        idx = idx0 + row*ustep
+        v = vis[idx]
+        if diag:
+            nxt[r2+2] += cur[r2 + selDiag[t]]*(contribDiag[t]*v)
+        if straight:
+            nxt[r2+1] += cur[r2 + selStraight[t]]*(contribStraight[t]*v)
+        amt = max(cur[r2] + cur[r2+1] - decay[t],0)
+        fdata[fidx0 + row*fustep] = amt
+        if onFovSetCallback:
+            onFovSetCallback(ivec2(px0 + ux*row,py0 + uy*row), amt)
+
+        if idx == dbgIdx:
+            # the contributor is the last neighbour that the cell propagated to
+            if straight:
+                src = selStraight[t]
+                amt_cur = cur[r2 + src]*(contribStraight[t]*v)
+            elif diag:
+                src = selDiag[t]
+                amt_cur = cur[r2 + src]*(contribDiag[t]*v)
+            else:
+                amt_cur = 0
+            fnContributorsToDebugPos([(ivec2(debugPos.x-1,debugPos.y) if src == 1 else ivec2(debugPos.x-1,debugPos.y-1),amt_cur)] if amt_cur > 0 else [])
+    
+def __sweep_octant( fwd, up, vx, vy, losRadius, visibilityMap, fdata, fbase, fstride, context, decay, onFovSetCallback = None, debugPos = None, fnContributorsToDebugPos = None):
+    # Propagate the visibility through the inner cells of an octant, one column at a time. The lines must be done
+    # decay: the decay of each cell, indexed like RhoTables.dist (see RhoTables.decay)
+    w = visibilityMap.width
+    h = visibilityMap.height
+    vis = visibilityMap.data
+    losRadiusSquared = losRadius*losRadius
+    rmax = math.ceil(losRadius)+1
     
+    # the per-column buffers of incoming values (see RhoContext), and the shared tables
+    context.reserve(rmax)
+    tables = rho_tables(rmax)
+    contribDiag = tables.contribDiag
+    contribStraight = tables.contribStraight
+    selDiag = tables.selDiag
+    selStraight = tables.selStraight
+    
+    # linear index of the debug position (-1 if there's none, or it's off the map)
+    dbgIdx = debugPos.x + debugPos.y*w if debugPos and visibilityMap.in_bounds(debugPos) else -1
+    
+    fx = fwd.x
+    fy = fwd.y
+    ux = up.x
+    uy = up.y
+    cur = context.cur
+    nxt = context.next
+    # index steps for moving up one row
+    ustep = ux + uy*w
+    fustep = ux + uy*fstride
+    # The valid rows of each column (in the map and within the los radius) are an interval [lo,hi], so the sweep
+    # runs over the intervals, instead of checking the bounds of each cell and of its neighbours
+    (nlo, nhi) = __column_rows( vx, vy, fx, fy, ux, uy, 1, w, h, losRadiusSquared)
+        
+    # skip the first column (the viewer), already calculated and contributes to no inner point directly.
+    # Column 1 only has line cells, so it doesn't read any incoming values either
+    for col in range(1,rmax):
+        # clear the incoming values of the next column (rows 0..col+1)
+        nxt[0:2*col+4] = array('d', [0.0]) * (2*col+4)
+
+        # first table index of the column
+        tcol = col*(col+1)//2
+        # the valid rows of this column, and the rows that update their top-right neighbour (col+1,row+1) and
+        # their right neighbour (col+1,row), that need to be valid too
+        (lo, hi) = (nlo, nhi)
+        (nlo, nhi) = __column_rows( vx, vy, fx, fy, ux, uy, col+1, w, h, losRadiusSquared)
+        dlo = lo if lo > nlo-1 else nlo-1
+        dhi = hi if hi < nhi-1 else nhi-1
+        slo = lo if lo > nlo else nlo
+        shi = hi if hi < nhi else nhi
+        # the position of row 0 of the column
+        px0 = vx + fx*col
+        py0 = vy + fy*col
+        idx0 = px0 + py0*w
+        fidx0 = fbase + fx*col + fy*col*fstride
+
+        # the straight line cell (row 0) only propagates, its value is final. It only updates its top-right neighbour
+        if lo == 0 <= hi:
+            if dlo <= 0 <= dhi:
+                src = selDiag[tcol]
+                amt_cur = fdata[fidx0] * (contribDiag[tcol]*vis[idx0])
+                nxt[2] += amt_cur
+                if idx0 == dbgIdx:
+                    fnContributorsToDebugPos([(ivec2(debugPos.x-1,debugPos.y) if src == 1 else ivec2(debugPos.x-1,debugPos.y-1),amt_cur)] if amt_cur > 0 else [])
+            elif idx0 == dbgIdx:
+                fnContributorsToDebugPos([])
+
+        # the inner cells of the column, in runs of rows that all update the same neighbours (see __row_runs), so
+        # the loops don't check any bounds. The incoming value that a cell propagates is picked by index:
+        # cur[2*row + sel] is the diagonal (sel 0) or straight (sel 1) one
+        a = lo if lo > 1 else 1
+        b = hi if hi < col-1 else col-1
+        if dlo <= a and slo <= a and dhi >= b and shi >= b:
+            # the usual case, away from the map edges and the los radius: all rows update both neighbours
+            runs = ((a, b+1, True, True),)
+        else:
+            runs = __row_runs( a, b, dlo, dhi, slo, shi)
+        for (start, end, diag, straight) in runs:
+            if onFovSetCallback or dbgIdx >= 0:
+                __sweep_rows_instrumented( start, end, diag, straight, col, tcol, idx0, fidx0, ustep, fustep, px0, py0, ux, uy,
+                                           vis, fdata, cur, nxt, tables, decay, dbgIdx, onFovSetCallback, debugPos, fnContributorsToDebugPos)
+            elif diag and straight:
+                for row in range(start, end):
+                    t = tcol+row
+                    r2 = 2*row
+                    v = vis[idx0 + row*ustep]
+                    nxt[r2+2] += cur[r2 + selDiag[t]]*(contribDiag[t]*v) # top-right neighbour, DIAG element
+                    nxt[r2+1] += cur[r2 + selStraight[t]]*(contribStraight[t]*v) # right neighbour, HORZ element
+                    # NOW apply the decay, after we've propagated. Inner cells are never used again
+                    fdata[fidx0 + row*fustep] = max(cur[r2] + cur[r2+1] - decay[t],0)
+            elif diag:
+                for row in range(start, end):
+                    t = tcol+row
+                    r2 = 2*row
+                    nxt[r2+2] += cur[r2 + selDiag[t]]*(contribDiag[t]*vis[idx0 + row*ustep])
+                    fdata[fidx0 + row*fustep] = max(cur[r2] + cur[r2+1] - decay[t],0)
+            elif straight:
+                for row in range(start, end):
+                    t = tcol+row
+                    r2 = 2*row
+                    nxt[r2+1] += cur[r2 + selStraight[t]]*(contribStraight[t]*vis[idx0 + row*ustep])
+                    fdata[fidx0 + row*fustep] = max(cur[r2] + cur[r2+1] - decay[t],0)
+            else:
+                for row in range(start, end):
+                    t = tcol+row
+                    fdata[fidx0 + row*fustep] = max(cur[2*row] + cur[2*row+1] - decay[t],0)
+
+        # the diagonal line cell (row col) only propagates, its value is final. It only updates its right neighbour
+        if lo <= col <= hi:
+            idx = idx0 + col*ustep
+            if slo <= col <= shi:
+                src = selStraight[tcol+col]
+                amt_cur = fdata[fidx0 + col*fustep] * (contribStraight[tcol+col]*vis[idx])
+                nxt[2*col+1] += amt_cur
+                if idx == dbgIdx:
+                    fnContributorsToDebugPos([(ivec2(debugPos.x-1,debugPos.y) if src == 1 else ivec2(debugPos.x-1,debugPos.y-1),amt_cur)] if amt_cur > 0 else [])
+            elif idx == dbgIdx:
+                fnContributorsToDebugPos([])
+                
+        # Early termination: if nothing propagates to the next column, and both lines are dark from there on, the rest
+        # of the octant is unseen. The buffer is zero-initialised, so that's only work for the callbacks
+        n = 2*col+4
+        if col+1 < rmax and nxt[0:n].count(0.0) == n:
+            ncol = col+1
+            if not (nlo <= 0 <= nhi and fdata[fbase + (fx + fy*fstride)*ncol] != 0) and \
+               not (nlo <= ncol <= nhi and fdata[fbase + (fx + ux + (fy + uy)*fstride)*ncol] != 0):
+                if onFovSetCallback or debugPos:
+                    __dark_octant_callbacks(fwd, up, vx, vy, ncol, rmax, w, h, losRadiusSquared, onFovSetCallback, debugPos, fnContributorsToDebugPos)
+                return
+        cur, nxt = nxt, cur
+        
+def __dark_octant_callbacks(fwd, up, vx, vy, startCol, rmax, w, h, losRadiusSquared, onFovSetCallback, debugPos, fnContributorsToDebugPos):
+    # the callbacks that the sweep of the remaining (unseen) columns of an octant would have made
+    for col in range(startCol, rmax):
+        for row in range(0, col+1):
+            ox = fwd.x*col + up.x*row
+            oy = fwd.y*col + up.y*row
+            if not __in_los(vx, vy, ox, oy, w, h, losRadiusSquared):
+                continue
+            if onFovSetCallback and row != col and row != 0:
+                onFovSetCallback(ivec2(vx+ox,vy+oy), 0)
+            if debugPos and vx+ox == debugPos.x and vy+oy == debugPos.y:
+                fnContributorsToDebugPos([])
+
 def fov_symmetry(losRadius, visibilityMap):
     import random
     w = visibilityMap.width
@@ -0,0 +1,133 @@
+import importlib
+from array import array
+
+"""
+    Bulk "touched tiles" output of the FoV engines, and diffs between consecutive results
+
+    The per-tile onFovSetCallback costs about as much as the FoV itself when it's only used to collect the results
+    (e.g. in a dict keyed by position). Instead, the visible tiles of a result can be extracted in bulk, as two
+    parallel arrays of linear map indices (x + y*width, ascending) and values, and two such results can be diffed in
+    one merge pass, so renderers and AI only process the tiles whose visibility changed.
+    With NumPy, the extraction and the diff are vectorized. Without it, they run as plain merges, with the same results.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class TouchedTiles(object):
+    """
+        The visible tiles of a FoV result: indices (linear map indices, ascending) and their values, as parallel arrays
+        The engines only write the tiles they visit into a zero-initialised result, so the touched tiles are the
+        ones with a non-zero value
+    """
+    def __init__(self, indices = None, values = None):
+        self.indices = array('q') if indices is None else indices
+        self.values = array('d') if values is None else values
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        # (index, value) pairs
+        return zip(self.indices, self.values)
+
+    def as_dict(self):
+        return dict(zip(self.indices, self.values))
+
+def touched(fovmap, mapWidth):
+    """
+    The touched tiles of a FoV result: a FovWindow (or anything with an origin), or a full-map result (origin (0,0))
+    mapWidth: width of the visibility map, for the linear indices
+    """
+    (ox, oy) = getattr(fovmap, 'origin', (0,0))
+    W = fovmap.width
+    data = fovmap.data
+    if np is not None and not isinstance(data, list):
+        vals = np.frombuffer(data, dtype=memoryview(data).format)
+        local = np.flatnonzero(vals)
+        indices = (local % W + ox) + (local // W + oy)*mapWidth
+        return TouchedTiles( array('q', indices.astype(np.int64).tobytes()), array('d', vals[local].astype(np.float64).tobytes()))
+
+    indices = array('q')
+    values = array('d')
+    for j in range(fovmap.height):
+        row = data[j*W:(j+1)*W]
+        # most rows of a window are fully dark (or fully lit), so skip the dark ones as a whole
+        if not any(row):
+            continue
+        base = ox + (oy+j)*mapWidth
+        for i,v in enumerate(row):
+            if v != 0:
+                indices.append(base + i)
+                values.append(v)
+    return TouchedTiles(indices, values)
+
+def diff(prev, cur, changedOnly = True):
+    """
+    The tiles whose visibility differs between two results (TouchedTiles), with their new values (0 for tiles that
+    are no longer visible). prev can be None (nothing visible before)
+    changedOnly: if False, return all tiles visible in either result instead (e.g. to redraw them with a new style)
+    Returns a TouchedTiles, indices ascending
+    """
+    if prev is None:
+        return TouchedTiles(array('q', cur.indices), array('d', cur.values))
+    if np is not None:
+        return __diff_numpy(prev, cur, changedOnly)
+
+    # merge the two ascending index lists
+    pi = prev.indices
+    pv = prev.values
+    ci = cur.indices
+    cv = cur.values
+    indices = array('q')
+    values = array('d')
+    a = 0
+    b = 0
+    na = len(pi)
+    nb = len(ci)
+    while a < na or b < nb:
+        if b == nb or (a < na and pi[a] < ci[b]):
+            # gone
+            indices.append(pi[a])
+            values.append(0.0)
+            a += 1
+        elif a == na or ci[b] < pi[a]:
+            # new
+            indices.append(ci[b])
+            values.append(cv[b])
+            b += 1
+        else:
+            # in both
+            if not changedOnly or pv[a] != cv[b]:
+                indices.append(ci[b])
+                values.append(cv[b])
+            a += 1
+            b += 1
+    return TouchedTiles(indices, values)
+
+def __diff_numpy(prev, cur, changedOnly):
+    pi = np.frombuffer(prev.indices, dtype=memoryview(prev.indices).format)
+    pv = np.frombuffer(prev.values, dtype=memoryview(prev.values).format)
+    ci = np.frombuffer(cur.indices, dtype=memoryview(cur.indices).format)
+    cv = np.frombuffer(cur.values, dtype=memoryview(cur.values).format)
+    # the position of each previous tile in the current result, and if it's there at all
+    pos = np.minimum(np.searchsorted(ci, pi), max(len(ci)-1, 0))
+    kept = (ci[pos] == pi) if len(ci) else np.zeros(len(pi), dtype=bool)
+    # the current tiles to output: all of them, or the new and changed ones
+    keep = np.ones(len(ci), dtype=bool)
+    if changedOnly:
+        keep[pos[kept][pv[kept] == cv[pos[kept]]]] = False
+    indices = np.concatenate((pi[~kept], ci[keep]))
+    values = np.concatenate((np.zeros(np.count_nonzero(~kept)), cv[keep]))
+    order = np.argsort(indices, kind='stable')
+    return TouchedTiles( array('q', indices[order].astype(np.int64).tobytes()), array('d', values[order].astype(np.float64).tobytes()))
+
+def fov_touched( viewerPos, losRadius, visibilityMap, algorithm = 'fov_rho', out = None):
+    """
+    Run the fov() of an engine module (e.g. 'fov_rho'), without per-tile callbacks, and return its touched tiles
+    out: optional FovWindow to reuse for the intermediate result
+    """
+    module = importlib.import_module(algorithm)
+    return touched(module.fov(viewerPos, losRadius, visibilityMap, out = out), visibilityMap.width)
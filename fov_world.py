@@ -0,0 +1,189 @@
+import sys
+import mmap
+import math
+import struct
+import importlib
+from array import array
+from collections import OrderedDict
+from mathutil import *
+
+"""
+    Chunked, memory-mapped visibility map for worlds too large to keep in memory
+
+    The world file stores the cells in square chunks (chunkSize x chunkSize, edge chunks padded), one after the other,
+    so a chunk is a single contiguous read. The file is memory-mapped, and the chunks in use are copied out to a
+    bounded LRU cache, so memory stays proportional to the active area, not to the world.
+
+    The engines address the visibility map with linear indices, so they don't run on the world directly: a FoV only
+    depends on the cells within its los radius, so ChunkedMap.fov copies that area (the (2r+1)^2 window around the
+    viewer, clipped to the world, reading only the chunks that intersect the los disk) into a small WorldRegion, and
+    runs the engine on it. The result is the same FovWindow as with the whole map, with its absolute origin.
+
+    File layout (little-endian): magic (8 bytes), width, height, chunkSize (uint32), typecode (1 byte), 3 bytes
+    padding, then the chunks in row order, each chunkSize*chunkSize values in row order
+"""
+
+WORLD_MAGIC = b'FOVWRLD1'
+_HEADER = struct.Struct('<8sIIIc3x')
+
+class WorldRegion(Map2D):
+    """
+        A rectangle of the world, copied to a Map2D. origin: absolute position of its (0,0) cell
+        It's a regular Map2D, indexed with positions relative to the origin
+    """
+    def __init__(self, origin, w, h, typecode):
+        Map2D.__init__(self, w, h, 0, typecode)
+        self.origin = origin
+
+    def to_local(self, point):
+        return ivec2(point.x - self.origin[0], point.y - self.origin[1])
+
+class ChunkedMap(object):
+    """
+        Visibility map stored in a chunked world file (see create()), with the get/set/in_bounds interface of Map2D
+        maxChunks: max number of chunks kept in memory (least recently used ones are evicted)
+        writable: if set() can be used. Edits go to the file (through the memory map) and to the cached chunk
+        Counters: loads (chunks read from the file), evictions
+    """
+    def __init__(self, filename, maxChunks = 256, writable = False):
+        self.filename = filename
+        self.maxChunks = maxChunks
+        self.writable = writable
+        with open(filename, 'r+b' if writable else 'rb') as f:
+            (magic, self.width, self.height, self.chunkSize, typecode) = _HEADER.unpack(f.read(_HEADER.size))
+            assert magic == WORLD_MAGIC, "not a world file: " + filename
+            self.typecode = typecode.decode('ascii')
+            self.__mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.chunksX = (self.width + self.chunkSize-1) // self.chunkSize
+        self.chunksY = (self.height + self.chunkSize-1) // self.chunkSize
+        self.chunkCells = self.chunkSize*self.chunkSize
+        self.__cells = memoryview(self.__mmap)[_HEADER.size:]
+        self.chunks = OrderedDict() # (cx,cy) -> array of the chunk's cells, least recently used first
+        self.loads = 0
+        self.evictions = 0
+
+    @classmethod
+    def create(cls, filename, width, height, chunkSize = 64, typecode = 'd', source = None, maxChunks = 256, writable = False):
+        """
+        Create a world file, with all cells 0, or copied from a source map (anything with get_fast(x,y), e.g. a Map2D)
+        Returns the ChunkedMap of the new file
+        """
+        chunksX = (width + chunkSize-1) // chunkSize
+        chunksY = (height + chunkSize-1) // chunkSize
+        chunkBytes = chunkSize*chunkSize*array(typecode).itemsize
+        with open(filename, 'wb') as f:
+            f.write(_HEADER.pack(WORLD_MAGIC, width, height, chunkSize, typecode.encode('ascii')))
+            if source is None:
+                # a sparse file of zeros
+                f.truncate(_HEADER.size + chunksX*chunksY*chunkBytes)
+            else:
+                for cy in range(chunksY):
+                    for cx in range(chunksX):
+                        chunk = array(typecode, [0]) * (chunkSize*chunkSize)
+                        x0 = cx*chunkSize
+                        y0 = cy*chunkSize
+                        for y in range(y0, min(y0+chunkSize, height)):
+                            for x in range(x0, min(x0+chunkSize, width)):
+                                chunk[(x-x0) + (y-y0)*chunkSize] = source.get_fast(x,y)
+                        if sys.byteorder == 'big':
+                            chunk.byteswap()
+                        f.write(chunk.tobytes())
+        return cls(filename, maxChunks, writable)
+
+    def close(self):
+        self.chunks.clear()
+        self.__cells.release()
+        self.__mmap.close()
+
+    def chunk(self, cx, cy):
+        # the cells of a chunk (an array, in row order), from the cache or loaded from the file
+        key = (cx,cy)
+        cells = self.chunks.get(key)
+        if cells is not None:
+            self.chunks.move_to_end(key)
+            return cells
+        start = (cx + cy*self.chunksX)*self.chunkCells*array(self.typecode).itemsize
+        cells = array(self.typecode)
+        cells.frombytes(self.__cells[start : start + self.chunkCells*cells.itemsize])
+        if sys.byteorder == 'big':
+            cells.byteswap()
+        self.loads += 1
+        self.chunks[key] = cells
+        while len(self.chunks) > self.maxChunks:
+            self.chunks.popitem(last=False)
+            self.evictions += 1
+        return cells
+
+    def in_bounds(self, point):
+        return point.x >= 0 and point.x < self.width and point.y >= 0 and point.y < self.height
+
+    def get_fast(self, x, y):
+        cs = self.chunkSize
+        return self.chunk(x // cs, y // cs)[x % cs + (y % cs)*cs]
+
+    def get(self, point):
+        return self.get_fast(point.x, point.y)
+
+    def set(self, point, value):
+        assert self.writable, "world opened read-only"
+        cs = self.chunkSize
+        (cx, cy) = (point.x // cs, point.y // cs)
+        i = point.x % cs + (point.y % cs)*cs
+        cells = self.chunks.get((cx,cy))
+        if cells is not None:
+            cells[i] = value
+        value = array(self.typecode, [value])
+        if sys.byteorder == 'big':
+            value.byteswap()
+        start = ((cx + cy*self.chunksX)*self.chunkCells + i)*value.itemsize
+        self.__cells[start : start + value.itemsize] = value.tobytes()
+
+    def region(self, x0, y0, w, h, center = None, radius = None):
+        """
+        Copy the cells of a rectangle of the world (clipped to the world) to a WorldRegion
+        center, radius: if given, only the chunks that intersect that disk are read. The cells of the other chunks
+                        are left 0 (for a FoV that can't see past the disk anyway)
+        """
+        x1 = min(x0 + w, self.width)
+        y1 = min(y0 + h, self.height)
+        x0 = max(x0, 0)
+        y0 = max(y0, 0)
+        region = WorldRegion((x0,y0), max(x1-x0, 0), max(y1-y0, 0), self.typecode)
+        cs = self.chunkSize
+        data = region.data
+        for cy in range(y0 // cs, (y1 + cs-1) // cs):
+            for cx in range(x0 // cs, (x1 + cs-1) // cs):
+                if center is not None:
+                    # closest point of the chunk to the center
+                    dx = max(cx*cs - center.x, 0, center.x - (cx*cs + cs-1))
+                    dy = max(cy*cs - center.y, 0, center.y - (cy*cs + cs-1))
+                    if dx*dx + dy*dy > radius*radius:
+                        continue
+                cells = self.chunk(cx, cy)
+                # the part of the chunk in the region, copied row by row
+                ax = max(x0, cx*cs)
+                bx = min(x1, cx*cs + cs)
+                for y in range(max(y0, cy*cs), min(y1, cy*cs + cs)):
+                    src = (ax - cx*cs) + (y - cy*cs)*cs
+                    dst = (ax - x0) + (y - y0)*region.width
+                    data[dst : dst + bx-ax] = cells[src : src + bx-ax]
+        return region
+
+    def region_around(self, viewerPos, losRadius, disk = True):
+        # the region that a FoV of the viewer can see: the (2r+1)^2 window around it, clipped to the world
+        # disk: only read the chunks that intersect the los disk (not the whole square)
+        r = int(math.ceil(losRadius))
+        return self.region(viewerPos.x - r, viewerPos.y - r, 2*r+1, 2*r+1, viewerPos if disk else None, losRadius)
+
+    def fov(self, viewerPos, losRadius, algorithm = 'fov_rho', out = None):
+        """
+        The FoV of the viewer with the fov() of an engine module (e.g. 'fov_rho'), run on the region around the viewer
+        out: optional FovWindow to reuse. Returns a FovWindow with absolute positions, like running on the whole map
+        """
+        module = importlib.import_module(algorithm)
+        # the permissive engine sees the whole square
+        region = self.region_around(viewerPos, losRadius, algorithm != 'fov_permissive')
+        (ox, oy) = region.origin
+        result = module.fov(region.to_local(viewerPos), losRadius, region, out = out)
+        result.origin = (result.origin[0] + ox, result.origin[1] + oy)
+        return result
@@ -1,14 +1,14 @@
-import os
 import datetime
 import tkinter as tk
 
 import fov_demoutil
+import fov_tiles
 import fov_rho as fov
 from mathutil import *
 
-# Get all maps
-mapnames = os.listdir('maps')
-visibilityMaps = [ fov_demoutil.load_from_file(f'maps/{x}')[0] for x in mapnames]
+# Get all maps (only the selected one gets loaded)
+visibilityMaps = fov_demoutil.MapList('maps')
+mapnames = visibilityMaps.names
 QUERY = "Select a map:\n" + "\n".join([ f"{i+1}. {x}"for i,x in enumerate(mapnames)])
 USE_VISIBILITY_MAP = 0
 print(QUERY)
@@ -25,13 +25,16 @@ while True:
         selection = input()
     else:
         break
-visibilityMap = visibilityMaps[USE_VISIBILITY_MAP]
+visibilityMap = visibilityMaps[USE_VISIBILITY_MAP][0]
 
 TILE_SIZE = 8
 LOS = 10
 
 g_canvas_rects = None
-g_prev_elems = {}
+g_prev_tiles = None # visible tiles of the last FoV (fov_tiles.TouchedTiles)
+g_prev_src = None
+g_prev_contributors = []
+g_prev_style = None
 g_binary_visibility = True
 g_binary_visibility_threshold = 0
 g_total_time = 0.0
@@ -40,15 +43,15 @@ g_hovered_vis_pt = None
 
 def rebuild_canvas(canvas, src, los, visibilityMap, on_fov_step_callback = None):
     global g_canvas_rects
-    global g_prev_elems
+    global g_prev_tiles
+    global g_prev_src
+    global g_prev_contributors
+    global g_prev_style
     global g_total_time
     global g_num_times
     
     w = visibilityMap.width
     h = visibilityMap.height
-    updated_elems = {}
-    def cb(p,v):
-        updated_elems[p] = v
     contributors = []
     def cb_contributors( points ):
         for p in points:
@@ -57,43 +60,45 @@ def rebuild_canvas(canvas, src, los, visibilityMap, on_fov_step_callback = None)
     fnContributors = None
     if g_hovered_vis_pt:
         fnContributors = cb_contributors
-    fovmap = fov.fov( src, los, visibilityMap, cb, g_hovered_vis_pt, fnContributors)
+    # no per-tile callback: the visible tiles are extracted from the result in bulk
+    fovmap = fov.fov( src, los, visibilityMap, None, g_hovered_vis_pt, fnContributors)
+    tiles = fov_tiles.touched(fovmap, w)
     g_total_time += (datetime.datetime.now() - start_time).total_seconds() * 0.001
     g_num_times += 1
-    print("Avg time so far: " + str(g_total_time / g_num_times) + " updated elems: " + str(len(updated_elems.keys())))
-    process_elems = updated_elems.copy()
+    print("Avg time so far: " + str(g_total_time / g_num_times) + " updated elems: " + str(len(tiles)))
     fcolor = ""
+    style = (g_binary_visibility, g_binary_visibility_threshold)
     first_time = g_canvas_rects is None
+    # the tiles to draw, as {linear index: visibility}
     if first_time:
         g_canvas_rects = [None] * len(visibilityMap.data)
         # First time we have to process ALL elements. So set all invisible elements to 0
-        for y in range(h):
-            for x in range(w):
-                p = ivec2(x,y)
-                if p not in updated_elems.keys():
-                    process_elems[p] = 0
+        process_elems = dict.fromkeys(range(w*h), 0)
+        process_elems.update(tiles.as_dict())
     else:
-        #print(len(g_prev_elems))
-        for k,v in g_prev_elems.items():
-            if k not in updated_elems.keys(): # if previous point not in updated elements, set visibility to 0
-                process_elems[k] = 0
-    for p, v in process_elems.items():
-        x = p.x
-        y = p.y
+        # only the tiles whose visibility changed, unless the style changed: then all the tiles visible before or now
+        process_elems = fov_tiles.diff(g_prev_tiles, tiles, style == g_prev_style).as_dict()
+        # the viewer tiles and the contributors are drawn differently regardless of their visibility, so redraw them too
+        for p in [g_prev_src, src] + [p for p,amt in g_prev_contributors]:
+            process_elems[p.x + p.y*w] = fovmap.get(p)
+    src_idx = src.x + src.y*w
+    for i, v in process_elems.items():
+        x = i % w
+        y = i // w
         vq = int(v*10)
         if g_binary_visibility:
             vq = 0 if g_binary_visibility_threshold >= vq else 10
-        blocker = visibilityMap.get(p) < 1
-        if src == p:
+        blocker = visibilityMap.data[i] < 1
+        if i == src_idx:
             fcolor = 'red'
         elif blocker:
             fcolor = 'magenta'
         else:
             fcolor = "#0{0}0".format(hex(6+vq-1)[2:])
         if first_time:
-            g_canvas_rects[x+y*w] = canvas.create_rectangle(x*TILE_SIZE, y*TILE_SIZE, (x+1)*TILE_SIZE, (y+1)*TILE_SIZE, fill= fcolor)
+            g_canvas_rects[i] = canvas.create_rectangle(x*TILE_SIZE, y*TILE_SIZE, (x+1)*TILE_SIZE, (y+1)*TILE_SIZE, fill= fcolor)
         else:
-            canvas.itemconfig(g_canvas_rects[x+y*w], fill=fcolor)
+            canvas.itemconfig(g_canvas_rects[i], fill=fcolor)
             
     if contributors:
         for p,amt in contributors:
@@ -104,7 +109,10 @@ def rebuild_canvas(canvas, src, los, visibilityMap, on_fov_step_callback = None)
             #fcolor = "yellow" if amt > 0 else "black"
             canvas.itemconfig(g_canvas_rects[x+y*w], fill=fcolor)
             
-    g_prev_elems = updated_elems
+    g_prev_tiles = tiles
+    g_prev_src = src
+    g_prev_contributors = contributors
+    g_prev_style = style
 
 g_mousehover_cursor = False
 g_cursor = ivec2(0,0)
@@ -166,7 +174,10 @@ def canvas_coords(evt):
 
 def blocker_change_transparency():    
     global visibilityMap
-    visibilityMap.data = [ (x if x == 1 else g_blocker_transparency) for x in visibilityMap.data]
+    data = visibilityMap.data # update in-place, to keep the typed storage
+    for i in range(len(data)):
+        if data[i] != 1:
+            data[i] = g_blocker_transparency
     update_title()
     rebuild_canvas(canvas, g_cursor, LOS, visibilityMap)
 
@@ -1,4 +1,3 @@
-import os
 import datetime
 import tkinter as tk
 
@@ -9,9 +8,9 @@ from mathutil import *
 
 fov.DECAY_PER_TILE_PERCENT = 0
 
-# Get all maps
-mapnames = os.listdir('maps')
-visibilityMaps = [ fov_demoutil.load_from_file(f'maps/{x}')[0] for x in mapnames]
+# Get all maps (only the selected one gets loaded)
+visibilityMaps = fov_demoutil.MapList('maps')
+mapnames = visibilityMaps.names
 QUERY = "Select a map:\n" + "\n".join([ f"{i+1}. {x}"for i,x in enumerate(mapnames)])
 USE_VISIBILITY_MAP = 0
 print(QUERY)
@@ -28,7 +27,7 @@ while True:
         selection = input()
     else:
         break
-visibilityMap = visibilityMaps[USE_VISIBILITY_MAP]
+visibilityMap = visibilityMaps[USE_VISIBILITY_MAP][0]
 
 TILE_SIZE = 8
 LOS = 9
@@ -174,7 +173,10 @@ def canvas_coords(evt):
 
 def blocker_change_transparency():    
     global visibilityMap
-    visibilityMap.data = [ (x if x == 1 else g_blocker_transparency) for x in visibilityMap.data]
+    data = visibilityMap.data # update in-place, to keep the typed storage
+    for i in range(len(data)):
+        if data[i] != 1:
+            data[i] = g_blocker_transparency
     update_title()
     rebuild_canvas(canvas, g_cursor, LOS, visibilityMap)
 
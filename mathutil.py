@@ -1,5 +1,8 @@
 import math
 import bisect
+import itertools
+from array import array
+from collections.abc import Sequence
 
 def sign(v):
     # v == 0: return  0
@@ -18,17 +21,42 @@ def step(a,t):
     return 0 if t < a else 1
     
 def smoothstep(a,b,t):
-    x = clamp((t-a)/(t-a),0,1)
+    x = clamp((t-a)/(b-a),0,1)
     return x*x*(3-2*x)
     
 def smootherstep(a,b,t):
-    x = clamp((t-a)/(t-a),0,1)
+    x = clamp((t-a)/(b-a),0,1)
     return x * x * x * (x * (x * 6 - 15) + 10)
     
+# Falloff curves of the distance decay, by name: map the distance as a fraction of the los radius (in [0,1]) to the
+# fraction of the full decay applied at that distance
+FALLOFFS = {
+    'linear' : lambda x: x,
+    'smoothstep' : lambda x: smoothstep(0,1,x),
+    'smootherstep' : lambda x: smootherstep(0,1,x),
+}
+
+def decay_table(distances, losRadius, decayPercent, falloff = 'linear'):
+    # the decay at each of the given distances from the viewer: decayPercent at losRadius, shaped by a falloff curve
+    # (see FALLOFFS). The linear one is computed exactly as distance * decay per tile
+    decayPerTile = decayPercent/float(losRadius)
+    if falloff == 'linear':
+        return array('d', [d*decayPerTile for d in distances])
+    curve = FALLOFFS[falloff]
+    return array('d', [decayPercent*curve(d/float(losRadius)) for d in distances])
+    
 def dot(v,q):
     return v[0]*q[0] + v[1]*q[1]
+    
+def normalized2(x, y):
+    # Unit vector (as a tuple) from plain scalars. return (0,0) if the vector is zero
+    l = math.sqrt(x*x + y*y)
+    mul = 1.0/l if l > 0.0 else 1
+    return (x*mul,y*mul)
 
 class ivec2(object):
+    __slots__ = ('x','y')
+    
     def __init__(self, x=0, y=0):
         self.x = int(x)
         self.y = int(y)
@@ -62,9 +90,7 @@ class ivec2(object):
 
     def normalized(self):
         # Return a unit vector based on this. return (0,0) if this vector is zero
-        l = self.length()
-        mul = 1.0/l if l > 0.0 else 1
-        return (self.x*mul,self.y*mul) # don't return ivec2 because it will be zero! (it's integer vector)
+        return normalized2(self.x, self.y) # don't return ivec2 because it will be zero! (it's integer vector)
 
     def __eq__(self,q):
         return self.x==q.x and self.y==q.y
@@ -83,41 +109,129 @@ class ivec2(object):
     def __hash__(self):
         return hash((self.x,self.y))
 
+class PointsView(Sequence):
+    """
+        A read-only, zero-copy view of a range [start,end) of a list of points, e.g. of SortedPoints.points
+        Indexing, iteration and len() work like on a list; slicing returns another view
+    """
+    __slots__ = ('points', 'start', 'end')
+    
+    def __init__(self, points, start, end):
+        self.points = points
+        self.start = start
+        self.end = end
+        
+    def __len__(self):
+        return self.end - self.start
+        
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            (start, stop, step) = i.indices(self.end - self.start)
+            if step != 1:
+                return self.points[self.start + start : self.start + stop : step]
+            return PointsView(self.points, self.start + start, self.start + max(start,stop))
+        if i < 0:
+            i += self.end - self.start
+        if i < 0 or i >= self.end - self.start:
+            raise IndexError("PointsView index out of range")
+        return self.points[self.start + i]
+        
+    def __iter__(self):
+        return itertools.islice(self.points, self.start, self.end)
+        
+    def __repr__(self):
+        return "PointsView[%d:%d]" % (self.start, self.end)
+
 class SortedPoints(object):
     """
         Store a list of ivec2 points, sorted by euclidean length, like starting from the origin and going outwards on a spiral
         Also store the squared lengths for each of the sorted points, so that we can do efficient binary search
+        The points are generated lazily: the list covers the disk of radius self.maxLos, and grows (only appending, so
+        indices and views stay valid) whenever a larger radius is requested. ringStarts[k] is the index of the first
+        point with length >= k, so ring k (k <= length < k+1) is [ringStarts[k], ringStarts[k+1])
     """
     
-    def __init__(self, maxLos):
+    def __init__(self, maxLos = 0):
+        self.maxLos = -1
         self.points = []
+        self.keys = []
+        self.ringStarts = [0]
+        self.reserve(maxLos)
+        
+    def reserve(self, maxLos):
+        # make sure all the points up to length maxLos are there. Grows at least x2, so growing costs O(1) per point
+        maxLos = int(math.ceil(maxLos))
+        if maxLos <= self.maxLos:
+            return
+        if self.maxLos > 0:
+            maxLos = max(maxLos, 2*self.maxLos)
+        # the new points are the ones of the annulus (old radius, new radius]. Equal lengths can't be split by the
+        # annulus, so appending the sorted annulus gives the same order as sorting the whole square at once
+        innerSquared = self.maxLos*self.maxLos if self.maxLos >= 0 else -1
+        outerSquared = maxLos*maxLos
+        annulus = []
         for y in range(-maxLos,maxLos+1):
             for x in range(-maxLos,maxLos+1):
-                self.points.append(ivec2(x,y))
-        self.points.sort(key=lambda p: p.squaredLength())
-        self.keys = [p.squaredLength() for p in self.points]
+                d = x*x + y*y
+                if d > innerSquared and d <= outerSquared:
+                    annulus.append(ivec2(x,y))
+        annulus.sort(key=lambda p: p.squaredLength())
+        self.points.extend(annulus)
+        self.keys.extend([p.squaredLength() for p in annulus])
+        self.maxLos = maxLos
+        # ring k is complete once (k+1)^2-1 <= maxLos^2
+        for k in range(len(self.ringStarts), maxLos+1):
+            self.ringStarts.append( bisect.bisect_left( self.keys, k*k))
                 
     def range(self, r_inner,r_outer):
+        # the points with r_inner <= length <= r_outer, as a zero-copy view
+        self.reserve(r_outer)
         r_inner_squared = r_inner*r_inner
         r_outer_squared = r_outer*r_outer
         i0 = bisect.bisect_left( self.keys, r_inner_squared)
         i1 = bisect.bisect_right( self.keys, r_outer_squared)
-        return self.points[i0:i1]
+        return PointsView(self.points, i0, i1)
         # Slower version of above
         #return [x for x in self.points if x.squaredLength() >= r_inner_squared and x.squaredLength() <= r_outer_squared]
         
+    def ring(self, k):
+        # the (start,end) indices of the points with k <= length < k+1
+        self.reserve(k+1)
+        return (self.ringStarts[k], self.ringStarts[k+1])
+        
 class Map2D(object):
     """
-        2D array class, storing the data as a 1D list
+        2D array class, storing the data as a 1D typed array (array.array, 'd' by default)
+        Pass default_value=None (or typecode=None) to store arbitrary python objects in a plain list instead
+        The typed storage supports the buffer protocol, so it can be exported to NumPy/PIL without any per-cell conversion
     """
-    def __init__(self, w,h, default_value = None):
+    def __init__(self, w,h, default_value = None, typecode = 'd'):
         self.width = w
         self.height = h
-        self.data = [default_value] * w*h
+        if default_value is None or typecode is None:
+            self.data = [default_value] * w*h
+        else:
+            self.data = array(typecode, [default_value]) * (w*h)
+            
+    @classmethod
+    def from_buffer(cls, w, h, data):
+        # Wrap existing storage (e.g. a memoryview over shared memory or a memory-mapped file) without copying it
+        m = cls.__new__(cls)
+        m.width = w
+        m.height = h
+        m.data = data
+        return m
         
     def linear_index(self, point):
         return point.x+point.y*self.width
         
+    # Integer linear-index API: the engines run on plain ints and precomputed index deltas (dx + dy*width)
+    def index(self, x, y):
+        return x+y*self.width
+        
+    def coords(self, index):
+        return (index % self.width, index // self.width)
+        
     def get(self, point ):
         assert( self.in_bounds(point))
         return self.data[ self.linear_index(point)]
@@ -130,5 +244,200 @@ class Map2D(object):
         assert( self.in_bounds(point))
         self.data[ self.linear_index(point)] += value
         
+    # Unchecked accessors for the hot loops: no bounds assertion, no linear_index() call
+    def get_fast(self, x, y):
+        return self.data[x+y*self.width]
+        
+    def set_fast(self, x, y, value):
+        self.data[x+y*self.width] = value
+        
     def in_bounds( self, point ):
-        return point.x >= 0 and point.x < self.width and point.y >= 0 and point.y < self.height
\ No newline at end of file
+        return point.x >= 0 and point.x < self.width and point.y >= 0 and point.y < self.height
+        
+    def buffer(self):
+        """
+            Zero-copy 2D (height x width) memoryview of the typed storage
+            e.g. numpy.asarray(m.buffer()) or PIL.Image.frombuffer('F', (m.width,m.height), m.buffer()) share memory with this map
+        """
+        if isinstance(self.data, list):
+            raise TypeError("Map2D with list storage does not support the buffer protocol")
+        view = memoryview(self.data)
+        return view.cast('B').cast(view.format, (self.height, self.width))
+        
+    def __buffer__(self, flags):
+        # python 3.12+: lets memoryview(m) / numpy.asarray(m) work on the map itself
+        return self.buffer()
+        
+    def as_numpy(self):
+        # Zero-copy numpy view (height x width). Requires numpy
+        import numpy
+        return numpy.asarray(self.buffer())
+        
+class FovWindow(Map2D):
+    """
+        FoV result covering only the (2r+1)^2 window around the viewer (r = ceil(losRadius)), which is all that a FoV can reach
+        The accessors take absolute map positions, like a full-map result. Cells outside the window read as 0
+        origin: absolute position of the window's (0,0) cell. Window cells outside the map stay 0
+        data: optional storage to reuse (a writable buffer of (2r+1)^2 doubles). It gets cleared
+    """
+    def __init__(self, viewerPos, losRadius, data = None):
+        self.half = int(math.ceil(losRadius))
+        self.width = self.height = 2*self.half+1
+        self.data = array('d', [0.0]) * (self.width*self.height) if data is None else data
+        self.reset(viewerPos)
+        
+    @classmethod
+    def reuse(cls, out, viewerPos, losRadius):
+        # out, cleared and moved to the viewer, if it's a window of the right size. Otherwise a new window
+        if out is not None and out.half == int(math.ceil(losRadius)):
+            return out.reset(viewerPos)
+        return cls(viewerPos, losRadius)
+        
+    @classmethod
+    def wrap(cls, origin, losRadius, data):
+        # window over existing data (e.g. a slice of a FovStack), without clearing it
+        w = cls.__new__(cls)
+        w.half = int(math.ceil(losRadius))
+        w.width = w.height = 2*w.half+1
+        w.data = data
+        w.origin = origin
+        return w
+        
+    def reset(self, viewerPos):
+        # clear the values and center the window on a new viewer position. Returns self
+        n = self.width*self.height
+        self.data[0:n] = array('d', [0.0]) * n
+        self.origin = (viewerPos.x - self.half, viewerPos.y - self.half)
+        return self
+        
+    def viewer_index(self):
+        # linear index of the viewer (the window center)
+        return self.half + self.half*self.width
+        
+    def linear_index(self, point):
+        return (point.x-self.origin[0])+(point.y-self.origin[1])*self.width
+        
+    def index(self, x, y):
+        return (x-self.origin[0])+(y-self.origin[1])*self.width
+        
+    def coords(self, index):
+        return (self.origin[0] + index % self.width, self.origin[1] + index // self.width)
+        
+    def in_bounds( self, point ):
+        x = point.x-self.origin[0]
+        y = point.y-self.origin[1]
+        return x >= 0 and x < self.width and y >= 0 and y < self.height
+        
+    def get(self, point ):
+        return self.data[ self.linear_index(point)] if self.in_bounds(point) else 0
+        
+    def get_fast(self, x, y):
+        return self.data[(x-self.origin[0])+(y-self.origin[1])*self.width]
+        
+    def set_fast(self, x, y, value):
+        self.data[(x-self.origin[0])+(y-self.origin[1])*self.width] = value
+        
+    def to_map(self, w, h):
+        # copy to a full w x h Map2D (e.g. for code that wants a map-sized result)
+        m = Map2D(w, h, 0)
+        (ox,oy) = self.origin
+        x0 = max(ox,0)
+        x1 = min(ox+self.width,w)
+        if x0 < x1:
+            for y in range(max(oy,0), min(oy+self.height,h)):
+                start = (x0-ox)+(y-oy)*self.width
+                m.data[x0+y*w : x1+y*w] = array('d', self.data[start : start+x1-x0])
+        return m
+        
+class VersionedMap2D(Map2D):
+    """
+        Map2D that tracks its edits: a version counter that increases on every change, and the dirty rectangles
+        (x0,y0,x1,y1), end-exclusive
+        Edits through set/add/set_fast/fill_rect are tracked. If data is written directly, call mark_dirty() for the edited area
+        Any number of consumers can follow the edits: each keeps the version it has seen, and asks for the rectangles
+        edited since (dirty_since). The log keeps the last MAX_DIRTY_LOG edits; older versions get the whole map.
+        take_dirty() is a consumer built in: the rectangles edited since its last call
+    """
+    MAX_DIRTY_LOG = 4096
+    
+    def __init__(self, w,h, default_value = None, typecode = 'd'):
+        Map2D.__init__(self, w, h, default_value, typecode)
+        self.__init_tracking()
+        
+    @classmethod
+    def from_map(cls, m):
+        # Versioned map sharing the storage of an existing Map2D
+        v = cls.from_buffer(m.width, m.height, m.data)
+        v.__init_tracking()
+        return v
+        
+    def __init_tracking(self):
+        self.version = 0
+        self.takenVersion = 0 # the version of the last take_dirty()
+        # the edit log: the rectangle of each edit, and its version (ascending). Edits up to logStart were dropped
+        self.logVersions = []
+        self.logRects = []
+        self.logStart = 0
+        
+    def mark_dirty(self, x0, y0, x1, y1):
+        # record an edit of the rectangle [x0,x1) x [y0,y1), clipped to the map
+        x0 = max(x0,0)
+        y0 = max(y0,0)
+        x1 = min(x1,self.width)
+        y1 = min(y1,self.height)
+        if x0 < x1 and y0 < y1:
+            self.version += 1
+            rect = (x0,y0,x1,y1)
+            # the same rectangle again only moves its last edit to the new version
+            if self.logRects and self.logRects[-1] == rect:
+                self.logVersions[-1] = self.version
+            else:
+                self.logVersions.append(self.version)
+                self.logRects.append(rect)
+                if len(self.logRects) > self.MAX_DIRTY_LOG:
+                    drop = len(self.logRects) // 2
+                    self.logStart = self.logVersions[drop-1]
+                    del self.logVersions[:drop]
+                    del self.logRects[:drop]
+        
+    def dirty_since(self, version):
+        # the rectangles edited after version (a previous value of self.version), oldest first. Doesn't change the map's state
+        if version < self.logStart:
+            # the log doesn't reach back that far
+            return [(0,0,self.width,self.height)]
+        return self.logRects[bisect.bisect_right(self.logVersions, version):]
+        
+    def take_dirty(self):
+        # return the dirty rectangles recorded since the last call
+        dirty = self.dirty_since(self.takenVersion)
+        self.takenVersion = self.version
+        return dirty
+        
+    def set(self, point, value):
+        assert( self.in_bounds(point))
+        self.set_fast(point.x, point.y, value)
+        
+    def add(self, point, value):
+        assert( self.in_bounds(point))
+        if value != 0:
+            self.data[ self.linear_index(point)] += value
+            self.mark_dirty(point.x, point.y, point.x+1, point.y+1)
+        
+    def set_fast(self, x, y, value):
+        i = x+y*self.width
+        if self.data[i] != value:
+            self.data[i] = value
+            self.mark_dirty(x, y, x+1, y+1)
+            
+    def fill_rect(self, x0, y0, x1, y1, value):
+        # set all the cells of the rectangle [x0,x1) x [y0,y1) (clipped to the map) to value
+        x0 = max(x0,0)
+        y0 = max(y0,0)
+        x1 = min(x1,self.width)
+        y1 = min(y1,self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        row = [value] * (x1-x0) if isinstance(self.data, list) else array(memoryview(self.data).format, [value]) * (x1-x0)
+        for y in range(y0,y1):
+            self.data[x0+y*self.width : x1+y*self.width] = row
+        self.mark_dirty(x0,y0,x1,y1)